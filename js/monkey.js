@@ -21,62 +21,138 @@ var ServiceClient = new Class({
         this._queue = [];
         this._running = false;
     },
+
+    // Makes several calls in one request. Each call is a list of an action,
+    // its arguments and optionally success and error callbacks.
+    batch: function (calls) {
+        var sc = this;
+        if (sc._running == true) {
+            sc._queue.push(function () { sc.batch(calls); });
+            return;
+        }
+
+        sc._running = true;
+
+        var body = calls.map(function (c) {
+            return { action: c[0], args: c[1] || {} };
+        });
+
+        sc._request(sc._path, JSON.encode(body), function (result) {
+            if (result.status != 'batch') {
+                sc._handle(result);
+                return;
+            }
+
+            for (var i = 0; i < calls.length; i++) {
+                sc._handle(result.response[i], calls[i][2], calls[i][3]);
+            }
+        });
+    },
+
+    busy: function () {
+        return this._running;
+    },
     
     call: function (action, args, onSuccess, onError) {
-        if (this._running == true) {
-            this._queue.push([action, args, onSuccess]);
+        var sc = this;
+        if (sc._running == true) {
+            sc._queue.push(function () { sc.call(action, args, onSuccess, onError); });
             return;
         }
 
-        this._running = true;
+        sc._running = true;
 
-        var params = { _time: +new Date() };
+        var params = {};
+        // Strings are sent as they are, since the service declares which
+        // arguments are strings. Other values are JSON encoded.
         $each(args, function (v, p) {
-            params[p] = JSON.encode(v);
+            if (v == null) return;
+            params[p] = $type(v) == 'string' ? v : JSON.encode(v);
+        });
+
+        sc._request(sc._path + action, params, function (result) {
+            sc._handle(result, onSuccess, onError);
         });
+    },
+
+    _handle: function (result, onSuccess, onError) {
+        switch (result.status) {
+            case 'error':
+                if (onError)
+                    onError(result.response);
+                else
+                    alert(result.response.type + ': ' + result.response.message);
+                break;
+            case 'list':
+                break;
+            case 'success':
+                if (onSuccess) onSuccess(result.response);
+                break;
+            default:
+                alert('Unknown status: ' + result.status);
+                break;
+        }
+    },
 
+    // Sends a request to the service. Data is sent as GET parameters, unless
+    // it's a string, in which case it's POSTed as JSON.
+    _request: function (url, data, onResult) {
         var sc = this;
+        var options = { data: data, method: $type(data) == 'string' ? 'post' : 'get' };
+
         var req = new Request.JSON({
             secure: false,
-            url: sc._path + action,
+            url: url,
+            urlEncoded: options.method == 'get',
+            headers: options.method == 'post' ? { 'Content-Type': 'application/json' } : {},
             onComplete: function (result) {
                 if (result) {
-                    switch (result.status) {
-                        case 'error':
-                            if (onError)
-                                onError(result.response);
-                            else
-                                alert(result.response.type + ': ' + result.response.message);
-                            break;
-                        case 'list':
-                            break;
-                        case 'success':
-                            if (onSuccess) onSuccess(result.response);
-                            break;
-                        default:
-                            alert('Unknown status: ' + result.status);
-                            break;
-                    }
+                    onResult(result);
                 } else {
                     if (this.attempts >= 3) {
                         alert('A request failed after repeated retries. Please reload the page.');
                     } else {
                         this.attempts++;
-                        this.get.delay(500, this, params);
+                        this.send.delay(500, this, options);
+                        return;
                     }
                 }
 
                 sc._running = false;
                 if (sc._queue.length > 0) {
-                    sc.call.apply(sc, sc._queue.shift());
+                    sc._queue.shift()();
                 }
             }
         });
         req.attempts = 1;
-        req.get(params);
+        req.send(options);
     }
 });
 
+// Decodes a board sent in the packed format (see Game.encode_board): base64 of
+// 4 bits per tile, column by column, into an m by n list of lists.
+function decodeBoard(data, m, n) {
+    var chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/';
+    var board = [], column, tile = 0, bits = 0, buffer = 0;
+
+    for (var i = 0; i < data.length && tile < m * n; i++) {
+        var value = chars.indexOf(data.charAt(i));
+        if (value < 0) continue;
+
+        buffer = (buffer << 6) | value;
+        bits += 6;
+        while (bits >= 4 && tile < m * n) {
+            bits -= 4;
+            if (tile % n == 0) board.push(column = []);
+            column.push((buffer >> bits) & 15);
+            tile++;
+        }
+        buffer &= (1 << bits) - 1;
+    }
+
+    return board;
+}
+
 var MonkeyService = new Class({
     Extends: ServiceClient,
 
@@ -101,7 +177,11 @@ var MonkeyService = new Class({
     },
 
     gameStatus: function (gameId, turn, onSuccess, onError) {
-        this.call('get_game_status', { game: gameId, turn: turn }, onSuccess, onError);
+        // Wait on the server for the turn to change instead of polling. The
+        // board is sent in the packed format, if at all.
+        var args = { game: gameId, turn: turn, packed: true };
+        if (turn != null) args.wait = true;
+        this.call('get_game_status', args, onSuccess, onError);
     },
     
     getRuleSets: function (onSuccess, onError) {
@@ -120,8 +200,9 @@ var MonkeyService = new Class({
         this.call('leave_game', { game: gameId }, onSuccess, onError);
     },
 
-    listGames: function (mode, onSuccess, onError) {
+    listGames: function (mode, cursor, onSuccess, onError) {
         var params = mode ? { mode: mode } : {};
+        if (cursor) params.cursor = cursor;
         this.call('get_games', params, onSuccess, onError);
     },
     
@@ -137,6 +218,9 @@ var MonkeyClient = new Class({
         mc.game = null;
         mc.gameId = null;
         mc.service = new MonkeyService();
+        // Game status requests can block on the server for a long time, so
+        // they get their own queue.
+        mc.statusService = new MonkeyService();
 
         var ruleSets;
 
@@ -245,24 +329,36 @@ var MonkeyClient = new Class({
             )
         });
 
-        mc.service.getRuleSets(function (list) {
-            mc.ruleSets = {};
-            for (var i = 0; i < list.length; i++) {
-                mc.ruleSets[list[i].id] = list[i];
-                new Element('option', { text: list[i].name, value: list[i].id }).inject(ruleSets);
-            }
-            ruleSets.value = list[0].id;
-        });
-
         mc.setMode(MonkeyClient.Mode.lobby, true);
-        mc.setListMode('play');
-        mc.refreshPlayer();
+        mc.setListMode('play', true);
+
+        // Everything needed to show the lobby is loaded in one request. The
+        // rule sets come first since the game list depends on them.
+        mc.service.batch([
+            ['get_rule_sets', {}, function (list) {
+                mc.ruleSets = {};
+                for (var i = 0; i < list.length; i++) {
+                    mc.ruleSets[list[i].id] = list[i];
+                    new Element('option', { text: list[i].name, value: list[i].id }).inject(ruleSets);
+                }
+                ruleSets.value = list[0].id;
+            }],
+            ['get_player_info', {}, mc.handlePlayer.bind(mc)],
+            ['get_games', { mode: 'play' }, mc.handleList.bind(mc)]
+        ]);
     },
     
     addCpuPlayer: function () {
         this.service.addCpuPlayer(this.gameId, this.refresh.bind(this));
     },
     
+    closeStream: function () {
+        if (this.stream) {
+            this.stream.close();
+            this.stream = null;
+        }
+    },
+
     cpuBattle: function (ruleSetId) {
         this.service.cpuBattle(ruleSetId, this.goToGame.bind(this));
     },
@@ -278,6 +374,39 @@ var MonkeyClient = new Class({
         if (game) this.handleStatus(game);
     },
     
+    handleGameEvent: function (status) {
+        var mc = this, game = mc.game;
+        if (!game || !status || status.turn == game.turn) return;
+
+        if (status.turn == game.turn + 1 && status.move && game.board) {
+            // Apply the move to the board instead of getting the whole status.
+            var move = status.move;
+            delete status.move;
+
+            game = $merge(game, status);
+            game.board[move[0]][move[1]] = move[2];
+            mc.handleStatus(game);
+        } else {
+            // Some changes were missed; get the moves since the last known
+            // turn. (Games played by CPU players are only stored now and
+            // then, so the moves may not be available right away.)
+            mc.refresh();
+        }
+    },
+
+    handleLobbyEvent: function () {
+        var mc = this;
+
+        // Games are updated all the time, so don't refresh more than every
+        // other second. Additional pages would be thrown away by refreshing,
+        // so don't refresh at all while they're shown.
+        if (mc.lobbyEventTimer || mc.listAppended) return;
+        mc.lobbyEventTimer = (function () {
+            mc.lobbyEventTimer = null;
+            if (mc.mode == MonkeyClient.Mode.lobby) mc.refresh();
+        }).delay(2000);
+    },
+
     handleList_playerTd: function (index, game) {
         var mc = this;
 
@@ -304,12 +433,14 @@ var MonkeyClient = new Class({
         }
     },
     
-    handleList: function (games) {
-        var mc = this;
+    handleList: function (result, append) {
+        var mc = this, games = result.games;
 
-        mc.html.gameList.empty();
+        if (!append) mc.html.gameList.empty();
+        mc.listAppended = append;
+        if (mc.html.moreGames) mc.html.moreGames.dispose();
 
-        if (games.length == 0) {
+        if (games.length == 0 && !append) {
             mc.html.gameList.adopt(new Element('tr').adopt(
                 new Element('td', {
                     'class': 'no-games',
@@ -361,14 +492,52 @@ var MonkeyClient = new Class({
                 }
             }
         }
-        
+
+        if (result.cursor) {
+            mc.html.moreGames = new Element('tr').adopt(
+                new Element('td', {
+                    'class': 'more-games',
+                    colspan: 3
+                }).adopt(new Element('a', {
+                    events: {
+                        click: mc.moreGames.bind(mc, result.cursor)
+                    },
+                    href: '#' + mc.listMode,
+                    text: 'Show more games'
+                }))
+            ).inject(mc.html.gameList);
+        }
+
+        // Refreshing would throw away the additional pages, so only refresh
+        // while the first page is shown. Changes are pushed while the lobby
+        // stream is open, so only poll without it.
         $clear(mc.timer);
-        mc.timer = mc.refresh.delay(5000, mc);
+        if (!append && !mc.stream) mc.timer = mc.refresh.delay(5000, mc);
     },
     
     handleStatus: function (game) {
         var mc = this;
 
+        if (game && $type(game.board) == 'string') {
+            var rs = mc.ruleSets[game.rule_set_id];
+            game.board = decodeBoard(game.board, rs.m, rs.n);
+        }
+
+        if (game && game.moves) {
+            // Only the moves since the last known turn were sent.
+            if (!mc.game || !mc.game.board) {
+                mc.service.gameStatus(mc.gameId, null, mc.handleStatus.bind(mc));
+                return;
+            }
+
+            game.board = mc.game.board;
+            for (var i = 0; i < game.moves.length; i++) {
+                var move = game.moves[i];
+                game.board[move[0]][move[1]] = move[2];
+            }
+            delete game.moves;
+        }
+
         if (game) {
             var pa = game.playing_as;
             var cp = game.current_player;
@@ -489,8 +658,11 @@ var MonkeyClient = new Class({
             mc.timer = mc.refresh.delay(2500, mc);
         } else if (mc.game.state == 'waiting') {
             mc.timer = mc.refresh.delay(5000, mc);
-        } else if (mc.game.state == 'playing') {
-            mc.timer = mc.refresh.delay(750, mc);
+        } else if (mc.game.state == 'playing' && !mc.stream) {
+            // Moves are pushed while the game stream is open. Otherwise, the
+            // server waits for the turn to change, so there's no need to wait
+            // here too.
+            mc.timer = mc.refresh.delay(50, mc);
         }
     },
     
@@ -589,6 +761,31 @@ var MonkeyClient = new Class({
         }
     },
     
+    moreGames: function (cursor) {
+        $clear(this.timer);
+        this.service.listGames(this.listMode, cursor, function (result) {
+            this.handleList(result, true);
+        }.bind(this));
+    },
+
+    openStream: function (url, onMessage) {
+        var mc = this;
+        if (!window.EventSource) return;
+
+        var stream = mc.stream = new EventSource(url);
+        stream.onmessage = function (e) {
+            if (stream == mc.stream) onMessage.call(mc, JSON.decode(e.data));
+        };
+        stream.onerror = function () {
+            // The browser reconnects on its own unless the stream is closed,
+            // in which case polling takes over.
+            if (stream == mc.stream && stream.readyState == EventSource.CLOSED) {
+                mc.stream = null;
+                mc.refresh();
+            }
+        };
+    },
+
     move: function (x, y) {
         if (this.mode == MonkeyClient.Mode.game) {
             this.service.move(this.gameId, x, y, this.handleStatus.bind(this));
@@ -600,11 +797,21 @@ var MonkeyClient = new Class({
 
         switch (this.mode) {
             case MonkeyClient.Mode.lobby:
-                this.service.listGames(this.listMode, this.handleList.bind(this));
+                this.service.listGames(this.listMode, null, this.handleList.bind(this));
                 break;
             case MonkeyClient.Mode.game:
+                // A request that's already waiting for the game to change
+                // will schedule the next refresh when it completes.
+                if (this.statusService.busy()) break;
+
+                var mc = this, gameId = this.gameId;
                 var t = this.game && this.game.state == 'playing' ? this.game.turn : null;
-                this.service.gameStatus(this.gameId, t, this.handleStatus.bind(this));
+                this.statusService.gameStatus(gameId, t, function (game) {
+                    // Ignore the response if the player moved on while the
+                    // request was waiting.
+                    if (mc.mode == MonkeyClient.Mode.game && mc.gameId == gameId)
+                        mc.handleStatus(game);
+                });
                 break;
         }
     },
@@ -613,7 +820,7 @@ var MonkeyClient = new Class({
         this.service.getPlayerInfo(this.handlePlayer.bind(this));
     },
     
-    setListMode: function (newMode) {
+    setListMode: function (newMode, skipRefresh) {
         this.html.gameList.empty().adopt(
             new Element('tr').adopt(
                 new Element('td', {
@@ -626,10 +833,12 @@ var MonkeyClient = new Class({
 
         this.html.lobby.set('class', 'lobby ' + newMode);
         this.listMode = newMode;
-        this.refresh();
+        if (!skipRefresh) this.refresh();
     },
     
     setMode: function (newMode, skipRefresh) {
+        this.closeStream();
+
         switch (this.mode) {
             case MonkeyClient.Mode.lobby:
                 this.html.lobby.dispose();
@@ -651,6 +860,7 @@ var MonkeyClient = new Class({
                 this.html.main.set('class', 'monkey in-lobby');
                 this.html.lobby.inject(this.html.main);
 
+                this.openStream('/stream/lobby/', this.handleLobbyEvent);
                 break;
             case MonkeyClient.Mode.game:
                 this.html.cells = null;
@@ -665,6 +875,7 @@ var MonkeyClient = new Class({
                 this.html.main.set('class', 'monkey in-game');
                 this.html.game.inject(this.html.main);
 
+                this.openStream('/stream/game/' + this.gameId, this.handleGameEvent);
                 break;
         }
         
@@ -22,52 +22,254 @@ Registers the WSGI web application with request handlers, also defined
 in this file.
 """
 
-from google.appengine.api import users
+from google.appengine.api import memcache, users
 from google.appengine.ext import db, webapp
 
 import wsgiref.handlers
 
 from datetime import datetime, timedelta
-import monkey, re, util
+import base64, monkey, re, time, util
+
+# Maximum number of games returned by one call to GameService.get_games. Same
+# as the size of the lobby cache, so that a cached page can be continued.
+PAGE_SIZE = monkey.LOBBY_SIZE
+
+# Maximum number of seconds that GameService.get_game_status waits for a game to
+# change.
+LONG_POLL_TIMEOUT = 20
+
+# Maximum number of moves that GameService.get_game_status sends instead of the
+# whole board.
+MAX_DELTA_MOVES = 50
+
+# Number of seconds between runs of the reaper on the development server.
+REAP_INTERVAL = 10 * 60
+
+# Limits of the rule sets that can be created. The cost of a CPU move grows
+# with m * n * k.
+MAX_BOARD_SIDE = 50
+MAX_BOARD_TILES = 1600
+MAX_CPU_COST = 1600 * 10
+
+# How often the actions that are expensive to serve can be called, as the rate
+# (calls per second) and burst of a token bucket, per player, per IP address
+# and in total. The address limit catches clients that drop their session to
+# become a new player on every call. It's higher than the player limit since
+# several players can share an address.
+RATE_LIMITS = {
+    'add_cpu_player': ((1 / 5.0, 10), (1.0, 30), (5.0, 100)),
+    'cpu_battle': ((1 / 60.0, 3), (1 / 20.0, 10), (1 / 2.0, 20)),
+    'create_rule_set': ((1 / 60.0, 5), (1 / 20.0, 15), (1 / 2.0, 20)),
+}
 
 class Error(Exception):
     """Base of all exceptions in the MoNKey! game interface."""
     pass
 
+class RateLimitError(Error):
+    """Thrown when an action has been called too often."""
+    pass
+
+_rate_limits = dict(
+    (action, (util.TokenBucket(action + ':player', *player),
+              util.TokenBucket(action + ':address', *address),
+              util.TokenBucket(action, *total)))
+    for action, (player, address, total) in RATE_LIMITS.iteritems())
+
+def decode_cursor(cursor):
+    """Gets the time of the last update and the id of the last game in a page
+    from a cursor created by encode_cursor. The id is None for cursors that
+    were created before it was included.
+    """
+    try:
+        parts = base64.urlsafe_b64decode(str(cursor)).split(':')
+        us = int(parts[0])
+        gid = int(parts[1]) if len(parts) > 1 else None
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    return datetime.utcfromtimestamp(0) + timedelta(microseconds = us), gid
+
+def encode_cursor(page):
+    """Returns an opaque cursor for the page following a page of game
+    summaries, or None if the page isn't full.
+
+    Since games are listed by the time they were last updated (and by id when
+    they were updated at the same time), the cursor only needs to hold the
+    time of the last update and the id of the last game in the page. This also
+    makes it possible to continue from a page that was served from the lobby
+    cache rather than a query.
+    """
+    if len(page) < PAGE_SIZE: return None
+    delta = page[-1]['last_update'] - datetime.utcfromtimestamp(0)
+    us = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return base64.urlsafe_b64encode('%d:%d' % (us, page[-1]['id']))
+
+def fetch_page(make_query, before = None):
+    """Returns the summaries of a page of games, most recently updated first,
+    following the game that a decoded cursor points to (see decode_cursor.)
+    make_query returns a new query for the games to list, without an order.
+
+    Games that were updated at the same time are listed by id, which is also
+    the order of the lobby cache (see monkey.Lobby.)
+    """
+    games = []
+    if before and before[1] is not None:
+        # Games updated at the same time as the last game of the previous page.
+        query = make_query()
+        query.filter('last_update =', before[0])
+        query.filter('__key__ >', db.Key.from_path('Game', before[1]))
+        games = query.fetch(PAGE_SIZE)
+
+    if len(games) < PAGE_SIZE:
+        query = make_query()
+        if before: query.filter('last_update <', before[0])
+        query.order('-last_update')
+        games += query.fetch(PAGE_SIZE - len(games))
+
+    return [game.summary() for game in games]
+
 class GameService(util.ServiceHandler):
     """Methods that can be called through HTTP (intended to be called by
     JavaScript through an XmlHttpRequest object.)
     """
+    _cache_control = { 'get_rule_sets': 'public, no-cache' }
+    # Long polls would hold up the rest of a batch.
+    _blocking_args = ('wait',)
+
+    # Shared by all requests, see get_game_status.
+    _status_flights = util.SingleFlight()
+
+    # The JSON of parts of responses that never change once they exist: the
+    # descriptions of rule sets (all but their number of games) and the status
+    # and players of completed games. Shared by all requests.
+    _fragments = util.LRUCache(1000)
+
+    def initialize(self, request, response):
+        util.ServiceHandler.initialize(self, request, response)
+
+        # Entities that have been fetched during the request. Shared by all
+        # the calls in a batch.
+        self._games = {}
+        self._player = None
+        self._rule_sets = {}
+
+    def _etag_get_game_status(self, game, turn = None, wait = False,
+                              packed = False):
+        # A call that waits for a change should not be answered right away.
+        if wait: return None
+        return self._player_version('game:%d' % game)
+
+    def _etag_get_games(self, mode = 'play', cursor = None):
+        # Later pages of games that others are playing change with every move
+        # anywhere.
+        if mode == 'view' and cursor: return None
+
+        # The shared lists of games (see monkey.Lobby.)
+        version = self._player_version('lobby')
+        if not version or mode == 'view': return version
+
+        # The games that the player is in. The key of the player is remembered
+        # by get_games, so that the player doesn't have to be loaded.
+        pkey = memcache.get('player:' + self._identity())
+        if not pkey: return None
+        return '%s|%s' % (version, util.get_version('lobby:%s' % pkey))
+
+    def _etag_get_rule_sets(self):
+        return util.get_version('rule_sets')
+
+    def _player_version(self, key):
+        """Returns a version (see util.get_version) for responses that depend
+        on the current player, or None if the player isn't known yet.
+        """
+        identity = self._identity()
+        if not identity: return None
+        return '%s|%s' % (identity, util.get_version(key))
+
+    def _get_game(self, game, reload = False):
+        """Gets a game by its id, or returns the game if it's already a Game
+        instance.
+        """
+        if isinstance(game, monkey.Game): return game
+
+        if reload or game not in self._games:
+            instance = monkey.Game.get_by_id(game)
+            if not instance: raise ValueError('Invalid game id.')
+
+            rule_set = monkey.Game.rule_set.get_value_for_datastore(instance)
+            instance.rule_set = self._get_rule_set(rule_set.id())
+            self._games[game] = instance
+
+        return self._games[game]
+
+    def _get_player(self):
+        """Gets the current player.
+        """
+        if not self._player:
+            self._player = monkey.Player.get_current(self)
+        return self._player
+
+    def _limit(self, action):
+        """Raises RateLimitError if the current player, the IP address of the
+        request or all players together have called an action too often (see
+        RATE_LIMITS.)
+        """
+        player, address, total = _rate_limits[action]
+        # The address is checked first, since getting the player creates a new
+        # one if the request has no session.
+        if not address.take(self.request.remote_addr or '') or \
+           not player.take(str(self._get_player().key())):
+            raise RateLimitError('You\'re doing that too often. Please try '
+                                 'again later.')
+        if not total.take():
+            raise RateLimitError('Too many players are doing that right now. '
+                                 'Please try again later.')
+
+    def _get_rule_set(self, rule_set):
+        """Gets a rule set by its id, or returns the rule set if it's already a
+        RuleSet instance.
+        """
+        if isinstance(rule_set, monkey.RuleSet): return rule_set
+
+        if rule_set not in self._rule_sets:
+            instance = monkey.RuleSet.get_by_id(rule_set)
+            if not instance: raise ValueError('Invalid rule set id.')
+            self._rule_sets[rule_set] = instance
+
+        return self._rule_sets[rule_set]
+
+    @util.action(game = int)
     def add_cpu_player(self, game):
         """Adds a CPU player to a game.
         """
-        if not isinstance(game, monkey.Game):
-            game = monkey.Game.get_by_id(game)
-            if not game:
-                raise ValueError('Invalid game id.')
+        game = self._get_game(game)
 
-        player = monkey.Player.get_current(self)
+        player = self._get_player()
         if not player.key() in game.players:
             raise Error('You cannot add a CPU player to a game you\'re not in.')
 
+        self._limit('add_cpu_player')
+
         cpu = monkey.CpuPlayer()
         cpu.join(game)
 
         return self.get_game_status(game)
 
+    @util.action(nickname = unicode)
     def change_nickname(self, nickname):
         """Changes the nickname of the current player.
         """
-        player = monkey.Player.get_current(self)
+        player = self._get_player()
         player.rename(nickname)
         return self.get_player_info()
 
+    @util.action(rule_set = int)
     def cpu_battle(self, rule_set):
-        """Creates a new game with only CPU players.
+        """Creates a new game with only CPU players. The game is played in the
+        background by monkey.run_battle.
         """
-        if not isinstance(rule_set, monkey.RuleSet):
-            rule_set = monkey.RuleSet.get_by_id(rule_set)
-            if not rule_set: raise ValueError('Invalid rule set id.')
+        rule_set = self._get_rule_set(rule_set)
+
+        self._limit('cpu_battle')
 
         game = monkey.Game(rule_set = rule_set)
         game.put()
@@ -78,14 +280,13 @@ class GameService(util.ServiceHandler):
 
         return game.key().id()
         
+    @util.action(rule_set = int)
     def create_game(self, rule_set):
         """Creates a new game.
         """
-        if not isinstance(rule_set, monkey.RuleSet):
-            rule_set = monkey.RuleSet.get_by_id(rule_set)
-            if not rule_set: raise ValueError('Invalid rule set id.')
+        rule_set = self._get_rule_set(rule_set)
 
-        player = monkey.Player.get_current(self)
+        player = self._get_player()
         game = monkey.Game(rule_set = rule_set)
         game.put()
 
@@ -93,14 +294,33 @@ class GameService(util.ServiceHandler):
 
         return game.key().id()
 
+    @util.action(name = unicode, m = int, n = int, k = int, p = int, q = int,
+                 num_players = int)
     def create_rule_set(self, name, m, n, k, p = 1, q = 1, num_players = 2):
-        """Creates a new rule set.
+        """Creates a new rule set. The size of the board is limited by
+        MAX_BOARD_SIDE and MAX_BOARD_TILES, and the cost of CPU moves by
+        MAX_CPU_COST.
         """
         if not re.match('^[\\w]([\\w&\'\\- ]{0,28}[\\w\'!])$', name):
             raise ValueError('Invalid name.')
 
+        if not (0 < m <= MAX_BOARD_SIDE and 0 < n <= MAX_BOARD_SIDE):
+            raise ValueError('The sides of the board can be at most %d tiles.'
+                             % MAX_BOARD_SIDE)
+        if m * n > MAX_BOARD_TILES:
+            raise ValueError('The board can have at most %d tiles.'
+                             % MAX_BOARD_TILES)
+        if not 0 < k <= max(m, n):
+            raise ValueError('The row needed to win must fit on the board.')
+        if m * n * k > MAX_CPU_COST:
+            raise ValueError('The board is too large for that row length.')
+        if not (0 < p <= m * n and 0 < q <= m * n):
+            raise ValueError('Too many tiles per turn.')
+
+        self._limit('create_rule_set')
+
         rule_set = monkey.RuleSet(name = name,
-                                  author = monkey.Player.get_current(self),
+                                  author = self._get_player(),
                                   num_players = num_players,
                                   m = m, n = n, k = k,
                                   p = p, q = q)
@@ -108,105 +328,217 @@ class GameService(util.ServiceHandler):
 
         return rule_set.key().id()
 
-    def get_game_status(self, game, turn = None):
-        """Gets the status of game.
+    def _fragment(self, key, value):
+        """Returns the JSON of a value that never changes, which is only
+        encoded the first time (see _fragments.)
+        """
+        json = self._fragments.get(key)
+        if json is None:
+            json = util.dumps(value)
+            self._fragments.set(key, json)
+        return json
+
+    def _game_status(self, game, turn, packed, reload = False):
+        """Returns the players of a game and the JSON encoded parts of its
+        status that are the same for everyone, or None if a turn is specified
+        and the game is still on it (or hasn't been stored at it yet.) See
+        get_game_status.
         """
         if not isinstance(game, monkey.Game):
-            game = monkey.Game.get_by_id(game)
-            if not game: raise ValueError('Invalid game id.')
+            # Completed games don't have to be loaded again.
+            completed = self._fragments.get(('status', game, packed))
+            if completed:
+                last_turn, players, status = completed
+                if turn == last_turn: return None
+                if turn is None: return (players, status)
+            loaded = True
+        else:
+            loaded = False
+
+        game = self._get_game(game, reload)
+        if loaded:
+            # Moves of CPU players are queued when a game is stored, so a game
+            # whose move was lost would never move. Only games that have been
+            # stuck for a while are queued again, so that reading the status
+            # doesn't usually touch the task queue.
+            game.resume_cpu()
+        if turn != None:
+            if game.turn == turn: return None
+            # The client is ahead of the stored game, which happens when it
+            # has seen moves of a CPU battle that were made after the last
+            # checkpoint (see monkey.run_battle). Wait for the game to be
+            # stored again rather than going back to an older board.
+            if game.state == 'playing' and turn > game.turn: return None
+
+        status = game.status()
+
+        moves = None
+        if turn != None and game.turn - turn <= MAX_DELTA_MOVES:
+            moves = game.moves_since(turn)
+        if moves is None:
+            status['board'] = game.encode_board() if packed else \
+                              game.unpack_board()
+        else:
+            status['moves'] = moves
+
+        status = util.dumps(status)
+        if game.finished and moves is None:
+            self._fragments.set(('status', game.key().id(), packed),
+                                (game.turn, game.players, status))
+        return (game.players, status)
+
+    @util.action(game = int, turn = int, wait = bool, packed = bool)
+    def get_game_status(self, game, turn = None, wait = False, packed = False):
+        """Gets the status of game.
 
-        if turn != None and game.turn == turn: return False
+        If a turn is specified and the game is still on that turn, False is
+        returned instead. If wait is True, the call blocks for up to
+        LONG_POLL_TIMEOUT seconds waiting for the turn to change before giving
+        up.
 
-        pkey = monkey.Player.get_current(self).key()
-        if pkey in game.players:
-            playing_as = game.players.index(pkey) + 1
+        If a turn is specified and the game has moved on, the status includes
+        the moves made since that turn instead of the whole board, unless
+        there are more than MAX_DELTA_MOVES of them. If packed is True, the
+        board is sent in the compact format of Game.encode_board instead of as
+        a list of columns.
+
+        Concurrent calls for the same game, turn and version of the game share
+        the work of loading the game and encoding its status. Only playing_as
+        differs between the players.
+        """
+        if isinstance(game, monkey.Game):
+            # Called by another action with a game that it just changed, so
+            # the status can't be shared with calls that started earlier.
+            result = self._game_status(game, turn, packed)
+        else:
+            # The version keeps a call made after the game changed from
+            # getting the status of a call that started before. Otherwise the
+            # old status would be cached under the new ETag.
+            version = util.get_version('game:%d' % game)
+            result = self._status_flights.do((game, turn, packed, version),
+                                             self._game_status,
+                                             game, turn, packed)
+
+        if result is None:
+            if not wait: return False
+
+            channel = 'game:%d' % game
+            deadline = time.time() + LONG_POLL_TIMEOUT
+            seen = turn
+            while result is None:
+                version, message = util.notifier.wait(
+                    channel, seen, max(0, deadline - time.time()))
+                if version in (None, seen): return False
+
+                result = self._status_flights.do((game, turn, packed, version),
+                                                 self._game_status,
+                                                 game, turn, packed, True)
+                # Otherwise the game has moved on but hasn't been stored yet,
+                # which happens between the checkpoints of a CPU battle (see
+                # monkey.run_battle). Wait for the next change.
+                if result is None and time.time() >= deadline: return False
+                seen = version
+
+        players, status = result
+
+        pkey = self._get_player().key()
+        if pkey in players:
+            playing_as = players.index(pkey) + 1
         else:
             playing_as = 0
-        
-        status = {
-            'players': game.player_names,
-            'board': game.unpack_board(),
-            'playing_as': playing_as,
-            'current_player': game.current_player,
-            'state': game.state,
-            'turn': game.turn,
-            'rule_set_id': game.rule_set.key().id() }
-
-        game.handle_cpu()
 
-        return status
+        return util.encoded('{"playing_as":%d,%s' % (playing_as, status[1:]))
 
-    def get_games(self, mode = 'play'):
-        """Returns a list of games relevant to the current player.
+    @util.action(mode = str, cursor = str)
+    def get_games(self, mode = 'play', cursor = None):
+        """Returns a page of games relevant to the current player, along with a
+        cursor for getting the next page (or None if there are no more games.)
 
         Modes:
             play - Returns games that the player is playing or can join.
             view - Returns games that other players are playing.
             past - Returns recent games that the player has played.
-        """
-        pkey = monkey.Player.get_current(self).key()
 
-        if mode == 'play':
-            playing = monkey.Game.all()
-            playing.filter('state =', 'playing')
-            playing.filter('players =', pkey)
-            playing.order('-last_update')
+        In play mode, the cursor pages through the games that the player is
+        playing. The games that can be joined are only included in the first
+        page.
+        """
+        pkey = self._get_player().key()
+        if mode != 'view':
+            # See _etag_get_games.
+            memcache.set('player:' + self._identity(), str(pkey))
 
-            waiting = monkey.Game.all()
-            waiting.filter('state =', 'waiting')
-            waiting.order('-last_update')
+        before = decode_cursor(cursor) if cursor else None
 
-            results = list(playing) + waiting.fetch(10)
+        if mode == 'play':
+            def playing():
+                query = monkey.Game.all()
+                query.filter('state =', 'playing')
+                query.filter('players =', pkey)
+                return query
+
+            results = fetch_page(playing, before)
+            cursor = encode_cursor(results)
+
+            # The games that the player is in come first, followed by the
+            # games that can be joined.
+            if not before: results += monkey.Lobby.get('waiting')
         elif mode == 'view':
-            playing = monkey.Game.all()
-            playing.filter('state =', 'playing')
-            playing.order('-last_update')
+            if not before:
+                results = monkey.Lobby.get('playing')
+            else:
+                def playing():
+                    query = monkey.Game.all()
+                    query.filter('state =', 'playing')
+                    return query
 
-            results = playing.fetch(10)
-        elif mode == 'past':
-            history = monkey.Game.gql('WHERE state IN :1 AND '
-                                      'players = :2 ORDER BY last_update DESC',
-                                      ['aborted', 'win', 'draw'], pkey)
+                results = fetch_page(playing, before)
 
-            results = history.fetch(10)
+            cursor = encode_cursor(results)
+        elif mode == 'past':
+            def history():
+                query = monkey.Game.all()
+                query.filter('players =', pkey)
+                query.filter('finished =', True)
+                return query
+
+            results = fetch_page(history, before)
+            cursor = encode_cursor(results)
         else:
             raise ValueError('Invalid mode.')
 
         now = datetime.utcnow()
+        pkey = str(pkey)
         games = []
         for game in results:
-            # Don't include games that can be considered abandoned.
-            # - Games that are waiting for players are considered abandoned
-            #   after six hours.
-            # - Games that are in play are considered abandoned after 48 hours.
-            age = now - game.last_update
-            age = age.seconds / 3600.0 + age.days * 24.0
-            if ((game.state == 'waiting' and age > 6) or
-                (game.state == 'playing' and age > 48)):
-                # Abort the game to speed up future queries.
-                game.abort()
-
-                # break instead of continue so that only one game is aborted per
-                # request (spreads out load between requests if many games have
-                # timed out since last request.)
-                break
+            # Abandoned games are aborted in the background by a scheduled job
+            # (see monkey.reap_games), until then they're just left out.
+            if monkey.is_abandoned(game['state'], game['last_update'], now):
+                continue
 
             # Determine the position of the player if the player is in the game.
-            if pkey in game.players:
-                playing_as = game.players.index(pkey) + 1
+            if pkey in game['player_keys']:
+                playing_as = game['player_keys'].index(pkey) + 1
             else:
                 playing_as = 0
 
+            # The players of completed games never change.
+            players = game['players']
+            if mode == 'past':
+                players = util.encoded(self._fragment(('players', game['id']),
+                                                      players))
+
             games.append({
-                'id': game.key().id(),
-                'players': game.player_names,
-                'current_player': game.current_player,
+                'id': game['id'],
+                'players': players,
+                'current_player': game['current_player'],
                 'playing_as': playing_as,
-                'rule_set_id': game.rule_set.key().id(),
-                'state': game.state })
+                'rule_set_id': game['rule_set_id'],
+                'state': game['state'] })
 
-        return games
-        
+        return { 'games': games, 'cursor': cursor }
+
+    @util.action()
     def get_player_info(self):
         """Gets information about the currently logged in player.
         """
@@ -216,7 +548,7 @@ class GameService(util.ServiceHandler):
         else:
             log_url = users.create_login_url('/')
         
-        player = monkey.Player.get_current(self)
+        player = self._get_player()
         return { 'nickname': player.nickname,
                  'anonymous': player.is_anonymous(),
                  'log_url': log_url,
@@ -224,59 +556,90 @@ class GameService(util.ServiceHandler):
                  'losses': player.losses,
                  'draws': player.draws }
 
+    @util.action()
     def get_rule_sets(self):
         """Gets all rule sets.
         """
         rule_sets = []
         for rule_set in monkey.RuleSet.get_list():
-            rule_sets.append({ 'id': rule_set.key().id(),
-                               'name': rule_set.name,
-                               'num_games': rule_set.num_games,
-                               'num_players': rule_set.num_players,
-                               'exact': rule_set.exact,
-                               'm': rule_set.m, 'n': rule_set.n,
-                               'k': rule_set.k, 'p': rule_set.p,
-                               'q': rule_set.q })
+            rule_set_id = rule_set.key().id()
+            self._rule_sets[rule_set_id] = rule_set
+
+            # Only the number of games changes, so the rest is encoded once.
+            description = self._fragment(('rule_set', rule_set_id), {
+                'id': rule_set_id,
+                'name': rule_set.name,
+                'num_players': rule_set.num_players,
+                'exact': rule_set.exact,
+                'm': rule_set.m, 'n': rule_set.n,
+                'k': rule_set.k, 'p': rule_set.p,
+                'q': rule_set.q })
+            rule_sets.append(util.encoded('{"num_games":%d,%s' % (
+                rule_set.num_games, description[1:])))
         return rule_sets
 
+    @util.action(game = int)
     def join_game(self, game):
         """Joins an existing game.
         """
-        if not isinstance(game, monkey.Game):
-            game = monkey.Game.get_by_id(game)
-            if not game: raise ValueError('Invalid game id.')
+        game = self._get_game(game)
 
-        player = monkey.Player.get_current(self)
+        player = self._get_player()
         player.join(game)
 
         return self.get_game_status(game)
 
+    @util.action(game = int)
     def leave_game(self, game):
         """Leaves an existing game.
         """
-        if not isinstance(game, monkey.Game):
-            game = monkey.Game.get_by_id(game)
-            if not game: raise ValueError('Invalid game id.')
+        game = self._get_game(game)
 
-        player = monkey.Player.get_current(self)
+        player = self._get_player()
         player.leave(game)
 
+    @util.action(game = int, x = int, y = int)
     def put_tile(self, game, x, y):
         """Places a tile on the board of the specified game.
         """
-        if not isinstance(game, monkey.Game):
-            game = monkey.Game.get_by_id(game)
-            if not game: raise ValueError('Invalid game id.')
+        game = self._get_game(game)
 
-        player = monkey.Player.get_current(self)
+        player = self._get_player()
+        turn = game.turn
         game.move(player, x, y)
 
-        return self.get_game_status(game)
+        return self.get_game_status(game, turn)
+
+class EventStream(util.StreamHandler):
+    """Pushes changes to a game or to the lobby as Server-Sent Events.
+    """
+    def _channel(self, kind, game):
+        if kind == 'lobby': return 'lobby'
+        return 'game:%d' % int(game)
+
+class ReapTask(webapp.RequestHandler):
+    """Aborts abandoned games. Called by the cron service (see cron.yaml.)
+    """
+    def get(self):
+        monkey.reap_games()
+
+# The development server does not run cron jobs, so run the reaper from a
+# thread instead.
+if util.is_development():
+    util.every(REAP_INTERVAL, monkey.reap_games)
+
+# The application is created once per instance and then used by all requests
+# (concurrently, since threadsafe is enabled in app.yaml.)
+application = webapp.WSGIApplication([
+    ('/game/(\\w*)', GameService),
+    ('/stream/(game)/(\\d+)', EventStream),
+    ('/stream/(lobby)/()', EventStream),
+    ('/tasks/reap', ReapTask),
+    ('/admin/profiles/(\\d*)', util.ProfilesHandler),
+    ('/admin/stats', util.StatsHandler)
+])
 
 def main():
-    application = webapp.WSGIApplication([
-        ('/game/(\\w*)', GameService)
-    ])
     wsgiref.handlers.CGIHandler().run(application)
 
 if __name__ == '__main__':
@@ -32,11 +32,11 @@ stones placed in the very first turn and p the number of stones placed in any
 subsequent turns.
 """
 
-from google.appengine.api import users
+from google.appengine.api import memcache, users
 from google.appengine.ext import db
 
 from datetime import datetime, timedelta
-import hashlib, random, re, string, time, util, uuid
+import base64, binascii, logging, random, re, string, threading, time, util
 
 class Error(Exception):
     """Base of all exceptions in the monkey module."""
@@ -66,6 +66,10 @@ class MoveError(Error):
     """Thrown when a move cannot be made."""
     pass
 
+class RegisterError(Error):
+    """Thrown when a player cannot be registered."""
+    pass
+
 class PlayerNameError(Error):
     """Thrown when an error related to the name of a player is encountered.
     """
@@ -75,6 +79,20 @@ class ForcedMove(Exception):
     """
     pass
 
+CPU_POOL_SIZE = 9
+
+_cpu_pool = None
+
+# Maximum number of CPU players that think at the same time in an instance.
+# Others wait for their turn.
+CPU_CONCURRENCY = 2
+
+_cpu_slots = threading.BoundedSemaphore(CPU_CONCURRENCY)
+
+# How long a game can be on a CPU player's turn before the move is considered
+# lost and is queued again (see Game.resume_cpu.)
+CPU_STALL_TIMEOUT = timedelta(seconds = 30)
+
 class CpuPlayer(object):
     def __init__(self, player = None, cleverness = 10.0):
         self.player = player
@@ -163,29 +181,71 @@ class CpuPlayer(object):
             if cpu: score += self.win_length * 2.0
             self.moves.append([score, move])
 
+    @staticmethod
+    def from_key(key):
+        """Gets a CpuPlayer instance for a player key, using the player pool
+        when possible.
+        """
+        for player in CpuPlayer.pool():
+            if player.key() == key: return CpuPlayer(player)
+        return CpuPlayer(db.get(key))
+
     def join(self, game):
         """Adds a CPU player to a game.
         """
-        players = Player.all()
-        players.filter('user =', users.User('cpu@mnk'))
-
         # Choose first CPU player that is not already in the game.
-        for player in players:
+        for player in CpuPlayer.pool():
             if player.key() not in game.players:
                 player.join(game)
                 self.player = player
                 return
 
-        # Create a new CPU player.
-        player = Player(user = users.User('cpu@mnk'),
-                        nickname = 'CPU')
-        player.put()
+        raise JoinError('There are no more CPU players available.')
 
-        player.join(game)
-        self.player = player
+    @staticmethod
+    def pool():
+        """Returns the fixed set of players that CPU players play as. The
+        players are created the first time they're needed and then kept in
+        memory for the lifetime of the instance.
 
-    def move(self, game):
-        """Performs an "intelligent" move.
+        There are as many players in the pool as there can be players in a
+        game, so that a game can be filled with CPU players.
+        """
+        global _cpu_pool
+        if _cpu_pool is None:
+            names = ['cpu-%d' % (i + 1) for i in xrange(CPU_POOL_SIZE)]
+            pool = Player.get_by_key_name(names)
+
+            missing = []
+            for i, name in enumerate(names):
+                if pool[i]: continue
+                pool[i] = Player(key_name = name,
+                                 user = users.User('cpu@mnk'),
+                                 nickname = 'CPU')
+                missing.append(pool[i])
+            db.put(missing)
+
+            _cpu_pool = pool
+        return _cpu_pool
+
+    def move(self, game, put = True):
+        """Performs an "intelligent" move. See Game.move for the put argument.
+
+        At most CPU_CONCURRENCY CPU players think at the same time.
+        """
+        if not self.player:
+            raise CpuError('Can not move before being assigned a player.')
+
+        _cpu_slots.acquire()
+        try:
+            x, y = self.think(game)
+        finally:
+            _cpu_slots.release()
+
+        game.move(self.player, x, y, put)
+
+    def think(self, game):
+        """Chooses the location of the next tile.
 
         How the CPU player thinks (choose first possible move):
         1. If CPU can win, do so!
@@ -194,9 +254,6 @@ class CpuPlayer(object):
         3. Value all possible moves and choose the one with the highest value.
         4. Place a tile near the middle of the board.
         """
-        if not self.player:
-            raise CpuError('Can not move before being assigned a player.')
-        
         self.board = game.unpack_board()
         self.index = game.players.index(self.player.key()) + 1
 
@@ -298,7 +355,7 @@ class CpuPlayer(object):
             for loc in locs:
                 if not self.board[loc[0]][loc[1]]: break
 
-        game.move(self.player, loc[0], loc[1])
+        return loc
 
     def valid(self, x, y):
         """Returns True if a position is valid; otherwise, False.
@@ -327,6 +384,14 @@ class Player(db.Model):
                             nickname = nickname)
             player.put()
 
+            # Nicknames of Google accounts aren't validated, and they're kept
+            # even if a registered player already has them, as before.
+            try:
+                Nickname.reserve(nickname, player)
+            except PlayerNameError:
+                logging.info('Nickname %r is used by more than one player.',
+                             nickname)
+
         return player
 
     @staticmethod
@@ -364,7 +429,7 @@ class Player(db.Model):
         The SHA-256 hash of the password must match the hash stored in the
         database, otherwise an exception will be raised.
         """
-        player = Player.all().filter('nickname =', nickname).get()
+        player = Nickname.lookup(nickname)
         if not player:
             raise LogInError('Could not find a player with the specified '
                              'nickname.')
@@ -372,6 +437,7 @@ class Player(db.Model):
         if player.user != users.User('player@mnk'):
             raise LogInError('Cannot log in as that user.')
 
+        import hashlib
         if hashlib.sha256(password).hexdigest() != player.password:
             raise LogInError('Invalid password.')
 
@@ -396,20 +462,28 @@ class Player(db.Model):
             raise RegisterError('Password should be at least 4 characters '
                                 'long.')
 
+        import hashlib
         player = Player(user = users.User('player@mnk'),
                         nickname = nickname,
                         password = hashlib.sha256(password).hexdigest())
+        player.put()
 
-        if handler:
-            player.start_session(handler)
-        else:
-            player.put()
+        try:
+            Nickname.reserve(nickname, player)
+        except PlayerNameError, e:
+            player.delete()
+            raise RegisterError('Could not use nickname (%s)' % (e))
+
+        if handler: player.start_session(handler)
 
         return player
         
     @staticmethod
     def validate(nickname):
         """Validates a nickname and throws an exception if it's invalid.
+
+        Whether the nickname is in use is determined when it's reserved (see
+        Nickname.reserve.)
         """
         if nickname in ('Anonymous', 'CPU'):
             raise PlayerNameError(nickname + ' is a reserved nickname.')
@@ -426,9 +500,6 @@ class Player(db.Model):
             raise PlayerNameError('Nickname must not be any longer than 20 '
                                   'characters.')
 
-        if Player.all().filter('nickname =', nickname).count() > 0:
-            raise PlayerNameError('Nickname is already in use.')
-
         return True
 
     def display_name(self):
@@ -437,6 +508,9 @@ class Player(db.Model):
     def is_anonymous(self):
         return self.user == users.User('anonymous@mnk')
 
+    def is_cpu(self):
+        return self.user == users.User('cpu@mnk')
+
     def join(self, game):
         """Convenience method for adding a player to a game.
         """
@@ -456,17 +530,17 @@ class Player(db.Model):
             pass
         else:
             Player.validate(nickname)
+            Nickname.reserve(nickname, self)
 
+        old_nickname = self.nickname
         self.nickname = nickname
         self.put()
 
-        # This results in very long query times and might have to be disabled.
-        # Everything would still work, it's just that games created before the
-        # player changed nickname will still show the old nickname.
-        games = Game.all().filter('players =', self.key())
-        for game in games:
-            game.update_player_names()
-            game.put()
+        Nickname.release(old_nickname, self)
+
+        # Updating the games can take a long time for players that have played
+        # a lot of games, so it's done in the background.
+        util.defer(rename_in_games, self.key())
 
     def end_session(self, handler):
         """Removes a session from the database and the client, effectively
@@ -484,6 +558,7 @@ class Player(db.Model):
         """Gives the player a session id and stores it as a cookie in the user's
         browser.
         """
+        import uuid
         self.session = uuid.uuid4().get_hex()
         self.expires = datetime.utcnow() + timedelta(days = 7)
         self.put()
@@ -496,6 +571,83 @@ class Player(db.Model):
         handler.response.headers['Set-Cookie'] = cookie
         handler.request.cookies['session'] = self.session
 
+class Nickname(db.Model):
+    """Reserves a nickname for a player. The key name is the nickname, which
+    makes nicknames unique and lets players be looked up by their nickname
+    without a query.
+
+    Nicknames are case-sensitive, like the queries that were used before they
+    were reserved, so that players whose nicknames only differ in case can
+    still log in.
+    """
+    player = db.ReferenceProperty(Player, required = True)
+
+    @staticmethod
+    def lookup(nickname):
+        """Gets the player that has reserved a nickname, or None if the
+        nickname is free.
+        """
+        reservation = Nickname.get_by_key_name(nickname)
+        if reservation: return reservation.player
+        return Nickname._reserve_unreserved(nickname)
+
+    @staticmethod
+    def _reserve_unreserved(nickname, exclude = None):
+        """Reserves a nickname for a player that was using it before nicknames
+        were reserved (see reserve_nicknames), and returns the player that has
+        reserved it. Returns None if no player other than exclude has it.
+
+        If several players have the nickname, registered players come first,
+        since they log in with it, followed by the oldest.
+        """
+        query = Player.all()
+        query.filter('nickname =', nickname)
+        players = [player for player in query.fetch(10)
+                   if player.key() != exclude and
+                   not player.is_anonymous() and not player.is_cpu()]
+        if not players: return None
+
+        players.sort(key = lambda player: (
+            player.user != users.User('player@mnk'), player.key().id()))
+        reservation = Nickname.get_or_insert(nickname, player = players[0])
+        if Nickname.player.get_value_for_datastore(reservation) == \
+           players[0].key():
+            return players[0]
+        return reservation.player
+
+    @staticmethod
+    def release(nickname, player):
+        """Makes a nickname available to other players, if it's reserved by
+        the specified player.
+        """
+        def txn():
+            reservation = Nickname.get_by_key_name(nickname)
+            if (reservation and
+                Nickname.player.get_value_for_datastore(reservation) == pkey):
+                reservation.delete()
+
+        pkey = player.key()
+        db.run_in_transaction(txn)
+
+    @staticmethod
+    def reserve(nickname, player):
+        """Reserves a nickname for a player. Throws an exception if the
+        nickname has already been reserved by another player, or if another
+        player had it before nicknames were reserved.
+        """
+        def txn():
+            reservation = Nickname.get_by_key_name(nickname)
+            if reservation:
+                if Nickname.player.get_value_for_datastore(reservation) != pkey:
+                    raise PlayerNameError('Nickname is already in use.')
+                return
+            Nickname(key_name = nickname, player = pkey).put()
+
+        pkey = player.key()
+        if not Nickname.get_by_key_name(nickname):
+            Nickname._reserve_unreserved(nickname, pkey)
+        db.run_in_transaction(txn)
+
 class RuleSet(db.Model):
     """A rule set for an m,n,k,p,q-game.
     """
@@ -530,6 +682,7 @@ class RuleSet(db.Model):
                 cls(name='Connect6', m=19, n=19, k=6, p=2, q=1),
             ]
             db.put(rule_sets)
+            util.bump_versions('rule_sets')
         return rule_sets
 
     def is_win(self, board, player, x, y):
@@ -561,6 +714,12 @@ class RuleSet(db.Model):
 
         return False
 
+    def put(self):
+        """Stores the rule set and changes the version of the rule set list.
+        """
+        db.Model.put(self)
+        util.bump_versions('rule_sets')
+
     def turns_left(self, turn):
         """Determine the number of turns until it's another player's turn.
         """
@@ -582,14 +741,20 @@ class Game(db.Model):
                                          'draw', 'win'))
     players = db.ListProperty(item_type = db.Key)
     player_names = db.StringListProperty()
+    # Whether the player in the same position in 'players' is a CPU player.
+    cpus = db.ListProperty(item_type = bool)
     current_player = db.IntegerProperty()
     turn = db.IntegerProperty(default = -1)
     data = db.StringListProperty()
+    # The position of the tile placed in each turn, as x * n + y.
+    moves = db.ListProperty(item_type = int, indexed = False)
     rule_set = db.ReferenceProperty(reference_class = RuleSet,
                                     required = True,
                                     collection_name = 'games')
     added = db.DateTimeProperty(auto_now_add = True)
     last_update = db.DateTimeProperty(auto_now_add = True)
+    # Lets the history of a player be queried without an IN filter on state.
+    finished = db.BooleanProperty(default = False)
 
     def add_player(self, player):
         """Adds a player to the game and starts the game if it has enough
@@ -602,11 +767,16 @@ class Game(db.Model):
         if self.state != 'waiting':
             raise JoinError('Game is not accepting new players.')
         
+        self.update_cpus()
         self.players.append(player.key())
+        self.cpus.append(player.is_cpu())
 
         # Start the game when it has enough players.
         if len(self.players) == self.rule_set.num_players:
-            random.shuffle(self.players)
+            seats = zip(self.players, self.cpus)
+            random.shuffle(seats)
+            self.players = [pkey for pkey, cpu in seats]
+            self.cpus = [cpu for pkey, cpu in seats]
             self.state = 'playing'
             self.turn = 0
             self.current_player = 1
@@ -628,19 +798,86 @@ class Game(db.Model):
             raise AbortError('Cannot abort a game that has already been '
                              'completed.')
 
+    def delete(self):
+        """Removes the game from the data store and from the lobby.
+        """
+        db.Model.delete(self)
+        Lobby.update(self, True)
+        util.bump_versions('game:%d' % self.key().id())
+
+    def encode_board(self):
+        """Returns the board as a compact string: the base64 encoding of 4 bits
+        per tile (the number of the player that owns it, or 0), going through
+        the board column by column with two tiles per byte. If the number of
+        tiles is odd, the last byte is padded with 0.
+        """
+        self.pack_board()
+        tiles = str(''.join(self.data))
+        if len(tiles) % 2: tiles += '0'
+        # Tiles are stored as digits, which are also valid hex digits.
+        return base64.b64encode(binascii.unhexlify(tiles))
+
+    def is_abandoned(self, now = None):
+        """Returns True if the game can be considered abandoned (see
+        is_abandoned.)
+        """
+        return is_abandoned(self.state, self.last_update, now)
+
     def handle_cpu(self):
         """If the current player is a CPU player, makes a move.
         """
         if self.state != 'playing': return
 
-        player = db.get(self.players[self.current_player - 1])
-        if player.user == users.User('cpu@mnk'):
-            cpu = CpuPlayer(player)
+        self.update_cpus()
+        if self.cpus[self.current_player - 1]:
+            cpu = CpuPlayer.from_key(self.players[self.current_player - 1])
             cpu.move(self)
+
+    def resume_cpu(self):
+        """Queues the move of the CPU player whose turn it is again if the game
+        has been on that turn for longer than CPU_STALL_TIMEOUT. That happens
+        when the queued move was lost, for example by a task that failed, or
+        when the game was already on a CPU player's turn before moves were
+        queued. Battles are left alone, since the stored game may be behind
+        the one being played.
+        """
+        if self.state != 'playing': return
+
+        stalled = datetime.utcnow() - self.last_update
+        if stalled < CPU_STALL_TIMEOUT: return
+
+        # The task names of earlier tries are taken, so each period of
+        # CPU_STALL_TIMEOUT gets a name of its own.
+        self.schedule_cpu(False, int(stalled.total_seconds() /
+                                     CPU_STALL_TIMEOUT.total_seconds()))
+
+    def schedule_cpu(self, battle = True, retry = 0):
+        """If the current player is a CPU player, queues its move to be made in
+        the background. Only one move is queued per game, turn and retry.
+        Games with only CPU players are played to the end by run_battle
+        instead, unless battle is False. That's needed when the game might not
+        be the latest version, since a battle is only stored now and then.
+        """
+        if self.state != 'playing' or hasattr(self, '_battle'): return
+
+        self.update_cpus()
+        if not self.cpus[self.current_player - 1]: return
+
+        gid = self.key().id()
+        suffix = '-%d' % retry if retry else ''
+        if False in self.cpus:
+            util.defer(play_cpu, gid, self.turn,
+                       _name = 'cpu-%d-%d%s' % (gid, self.turn, suffix))
+        elif battle:
+            util.defer(run_battle, gid, self.turn,
+                       _name = 'battle-%d-%d%s' % (gid, self.turn, suffix))
     
-    def move(self, player, x, y):
+    def move(self, player, x, y, put = True):
         """Puts a tile at the specified coordinates and makes sure all game
         rules are followed.
+
+        If put is False, the game is not stored (but the players' statistics
+        still are, if the game ends.)
         """
         pkey = player.key()
         if pkey not in self.players: raise MoveError('Player not in game.')
@@ -661,6 +898,8 @@ class Game(db.Model):
             board[x][y]): raise MoveError('Invalid tile position.')
 
         board[x][y] = whose_turn
+        self.moves.append(x * n + y)
+        self._move = [x, y, whose_turn]
 
         # Next turn.
         self.turn += 1
@@ -669,13 +908,16 @@ class Game(db.Model):
         if rs.is_win(board, player_turn, x, y):
             self.state = 'win'
 
-            player.wins += 1
-            player.put()
-            for pkey in self.players:
-                if pkey == player.key(): continue
-                p = db.get(pkey)
-                p.losses += 1
-                p.put()
+            # The players are fetched again rather than updating the supplied
+            # player, since CPU player instances are shared (see
+            # CpuPlayer.pool.)
+            players = db.get(self.players)
+            for p in players:
+                if p.key() == pkey:
+                    p.wins += 1
+                else:
+                    p.losses += 1
+            db.put(players)
 
             self.rule_set.num_games += 1
             self.rule_set.put()
@@ -683,17 +925,29 @@ class Game(db.Model):
         elif not util.contains(board, 0):
             self.state = 'draw'
 
-            for pkey in self.players:
-                p = db.get(pkey)
+            players = db.get(self.players)
+            for p in players:
                 p.draws += 1
-                p.put()
+            db.put(players)
 
             self.rule_set.num_games += 1
             self.rule_set.put()
         else:
             self.current_player = rs.whose_turn(self.turn)
 
-        self.put(True)
+        if put: self.put(True)
+
+    def moves_since(self, turn):
+        """Returns the moves made since the specified turn as [x, y, player]
+        lists, or None if they're not known (for example, for games that were
+        started before moves were stored.)
+        """
+        if turn < 0 or turn > self.turn or len(self.moves) != self.turn:
+            return None
+
+        rs = self.rule_set
+        return [[move // rs.n, move % rs.n, rs.whose_turn(i)]
+                for i, move in enumerate(self.moves[turn:], turn)]
 
     def pack_board(self):
         """Packs a list of lists into a list of strings, where each character
@@ -715,9 +969,24 @@ class Game(db.Model):
             self.data = ['0' * self.rule_set.m
                          for i in xrange(self.rule_set.n)]
 
+        self.finished = self.state in ('aborted', 'draw', 'win')
         if update_time: self.last_update = datetime.utcnow()
         db.Model.put(self)
 
+        Lobby.update(self)
+        self.publish()
+        self.schedule_cpu()
+
+    def publish(self):
+        """Notifies anyone waiting for the game to change of its current
+        status. The status includes the last move, if it was made by this
+        instance.
+        """
+        status = self.status()
+        if hasattr(self, '_move'): status['move'] = self._move
+        util.notifier.notify('game:%d' % self.key().id(), self.turn, status)
+        util.bump_versions('game:%d' % self.key().id())
+
     def remove_player(self, player):
         """Removes a player from the game or deletes the game if removing the
         player would make the game empty from players.
@@ -726,16 +995,13 @@ class Game(db.Model):
             raise LeaveError('Player is not in game.')
 
         if self.state == 'waiting':
-            self.players.remove(player.key())
-
-            # Determine the number of non-CPU players.
-            humans = len(self.players)
-            for pkey in self.players:
-                if db.get(pkey).user == users.User('cpu@mnk'):
-                    humans -= 1
+            self.update_cpus()
+            index = self.players.index(player.key())
+            del self.players[index]
+            del self.cpus[index]
 
             # Only keep the game if there are non-CPU players left in the game.
-            if humans > 0:
+            if False in self.cpus:
                 self.update_player_names()
                 self.put(True)
             else:
@@ -757,9 +1023,358 @@ class Game(db.Model):
                            for row in self.data]
         return self._board
 
+    def status(self):
+        """Returns the parts of the status of the game that are the same for
+        all players.
+        """
+        return {
+            'players': self.player_names,
+            'current_player': self.current_player,
+            'state': self.state,
+            'turn': self.turn,
+            'rule_set_id': Game.rule_set.get_value_for_datastore(self).id() }
+
+    def summary(self):
+        """Returns a dictionary with the information about the game that is
+        needed to list it in the lobby.
+        """
+        return {
+            'id': self.key().id(),
+            'players': self.player_names,
+            'player_keys': [str(pkey) for pkey in self.players],
+            'current_player': self.current_player,
+            'state': self.state,
+            'rule_set_id': Game.rule_set.get_value_for_datastore(self).id(),
+            'last_update': self.last_update }
+
+    def update_cpus(self):
+        """Fills in the 'cpus' list for games that were created before it was
+        introduced.
+        """
+        if len(self.cpus) == len(self.players): return
+        self.cpus = [p.is_cpu() for p in db.get(self.players)]
+
     def update_player_names(self):
         """Synchronizes the 'player_names' list with the names of the players in
         the game.
         """
-        self.player_names = [db.get(p).nickname
-                             for p in self.players]
+        self.player_names = [p.nickname for p in db.get(self.players)]
+
+LOBBY_SIZE = 10
+LOBBY_RETRIES = 3
+
+class Lobby(object):
+    """A materialized view of the most recently updated games that are waiting
+    for players or in play. The summaries (see Game.summary) are kept in
+    memcache and updated whenever a game is stored, so that listing games
+    doesn't have to query the data store.
+
+    Besides the shared lists, the lobby of each player shows the games that
+    the player is in. Those are tracked by a version per player (see
+    util.get_version), which is changed whenever one of the games changes.
+    """
+    STATES = ('waiting', 'playing')
+    # The fields of the summaries that are shown in the lobby. Changes to the
+    # other fields, such as last_update, don't change what players see.
+    SHOWN = ('id', 'players', 'player_keys', 'current_player', 'rule_set_id',
+             'state')
+
+    @staticmethod
+    def bump(players):
+        """Changes the lobby versions of the specified players (keys.)
+        """
+        util.bump_versions(*['lobby:%s' % pkey for pkey in players])
+
+    @staticmethod
+    def clear():
+        """Removes the cached lists so that they're rebuilt the next time they
+        are needed.
+        """
+        memcache.delete_multi(['lobby:' + state for state in Lobby.STATES])
+        util.notifier.notify('lobby', time.time())
+        util.bump_versions('lobby')
+
+    @staticmethod
+    def get(state):
+        """Returns a list of summaries of the most recently updated games in the
+        specified state, newest first.
+        """
+        games = memcache.get('lobby:' + state)
+        if games is None:
+            query = Game.all()
+            query.filter('state =', state)
+            query.order('-last_update')
+            games = [game.summary() for game in query.fetch(LOBBY_SIZE)]
+            memcache.add('lobby:' + state, games)
+        return games
+
+    @staticmethod
+    def shown(games):
+        """Returns what the lobby shows of a list of summaries.
+        """
+        return [[g[field] for field in Lobby.SHOWN] for g in games]
+
+    @staticmethod
+    def update(game, deleted = False):
+        """Updates the cached lists with the current state of a game and
+        changes the lobby versions of the players in the game. Only if one of
+        the lists changed is the shared lobby version changed and anyone
+        waiting for the lobby to change notified.
+        """
+        client = memcache.Client()
+        gid = game.key().id()
+        changed = False
+        for state in Lobby.STATES:
+            key = 'lobby:' + state
+            for i in xrange(LOBBY_RETRIES):
+                games = client.gets(key)
+                # The list will be rebuilt when it's needed, and it's not
+                # known whether the game was in it.
+                if games is None:
+                    changed = True
+                    break
+
+                updated = [g for g in games if g['id'] != gid]
+                if not deleted and game.state == state:
+                    updated.append(game.summary())
+                    # Newest first, and by id when updated at the same time,
+                    # like the queries of GameService.get_games.
+                    updated.sort(key = lambda g: (g['last_update'], -g['id']),
+                                 reverse = True)
+                    updated = updated[:LOBBY_SIZE]
+                elif len(updated) < len(games) == LOBBY_SIZE:
+                    # A game was removed from a full list, which means that
+                    # there might be games in the data store that should take
+                    # its place.
+                    client.delete(key)
+                    changed = True
+                    break
+
+                if updated == games: break
+                if client.cas(key, updated):
+                    if Lobby.shown(updated) != Lobby.shown(games):
+                        changed = True
+                    break
+            else:
+                # Too much contention; let the list be rebuilt instead.
+                client.delete(key)
+                changed = True
+
+        if changed:
+            util.notifier.notify('lobby', time.time(), { 'id': gid })
+            util.bump_versions('lobby')
+        Lobby.bump(game.players)
+
+def play_cpu(game_id, turn):
+    """Makes the move of the CPU player whose turn it is in a game, unless the
+    game has moved on from the specified turn. Queued by Game.schedule_cpu.
+    """
+    game = Game.get_by_id(game_id)
+    if not game or game.turn != turn: return
+    game.handle_cpu()
+
+BATTLE_CHECKPOINT = 10
+BATTLE_TIME_LIMIT = 60
+
+def run_battle(game_id, turn):
+    """Plays a game with only CPU players to the end, keeping it in memory.
+    Anyone watching the game is notified of every move, but the game is only
+    stored every BATTLE_CHECKPOINT moves and when it ends.
+
+    If the game takes longer than BATTLE_TIME_LIMIT seconds, it's stored and
+    another task is queued to continue it.
+
+    The game continues from the last stored turn rather than the specified
+    one, which is the turn the task was queued for. That way a task that is
+    retried after failing past a checkpoint picks up from the checkpoint. The
+    name of the task (see Game.schedule_cpu) keeps a battle from being run by
+    more than one task.
+    """
+    game = Game.get_by_id(game_id)
+    if not game or game.state != 'playing': return
+
+    game.update_cpus()
+    if False in game.cpus: return
+
+    # Keeps Game.put from queueing moves while the game is being played.
+    game._battle = True
+
+    cpus = dict((pkey, CpuPlayer.from_key(pkey)) for pkey in game.players)
+    deadline = time.time() + BATTLE_TIME_LIMIT
+    moves = 0
+    while game.state == 'playing':
+        cpus[game.players[game.current_player - 1]].move(game, False)
+        moves += 1
+        if game.state != 'playing': break
+
+        if time.time() > deadline:
+            # Let Game.put queue a task that continues the game.
+            del game._battle
+            break
+
+        if moves % BATTLE_CHECKPOINT:
+            game.publish()
+        else:
+            game.put(True)
+
+    game.put(True)
+
+RENAME_BATCH_SIZE = 50
+
+def rename_in_games(player_key, states = ('waiting', 'playing'), cursor = None):
+    """Updates the player names of the games that a player is in. Only games
+    that are still waiting or in play are updated, since the names of completed
+    games don't matter much.
+
+    Handles one batch of games per call, then queues itself to continue where
+    it left off.
+    """
+    query = Game.all(keys_only = True)
+    query.filter('players =', player_key)
+    query.filter('state =', states[0])
+    query.order('-last_update')
+    if cursor: query.with_cursor(cursor)
+
+    keys = query.fetch(RENAME_BATCH_SIZE)
+    nickname = Player.get(player_key).nickname
+
+    def txn(key):
+        # The games are in play, so each one is changed in a transaction to
+        # not overwrite moves made meanwhile.
+        game = Game.get(key)
+        if not game or player_key not in game.players: return None
+        index = game.players.index(player_key)
+        if index >= len(game.player_names): return None
+        if game.player_names[index] == nickname: return None
+        game.player_names[index] = nickname
+        # The board hasn't been unpacked so there is no need to go through
+        # Game.put.
+        db.Model.put(game)
+        return game
+
+    games = filter(None, [db.run_in_transaction(txn, key) for key in keys])
+    for game in games:
+        Lobby.update(game)
+        game.publish()
+
+    if len(keys) == RENAME_BATCH_SIZE:
+        util.defer(rename_in_games, player_key, states, query.cursor())
+    elif len(states) > 1:
+        util.defer(rename_in_games, player_key, states[1:])
+
+WAITING_TIMEOUT = timedelta(hours = 6)
+PLAYING_TIMEOUT = timedelta(hours = 48)
+REAP_BATCH_SIZE = 100
+
+def is_abandoned(state, last_update, now = None):
+    """Returns True if a game in the specified state, last updated at the
+    specified time, can be considered abandoned.
+
+    - Games that are waiting for players are considered abandoned after six
+      hours.
+    - Games that are in play are considered abandoned after 48 hours.
+    """
+    if state == 'waiting':
+        timeout = WAITING_TIMEOUT
+    elif state == 'playing':
+        timeout = PLAYING_TIMEOUT
+    else:
+        return False
+
+    if not now: now = datetime.utcnow()
+    return now - last_update > timeout
+
+def reap_games():
+    """Aborts games that have been abandoned (see Game.is_abandoned.)
+
+    Handles one batch of games of each state per call, then queues itself if
+    there might be more games to abort.
+    """
+    now = datetime.utcnow()
+
+    # Aborting a game that is waiting for players removes it, so only the keys
+    # are needed.
+    query = Game.all(keys_only = True)
+    query.filter('state =', 'waiting')
+    query.filter('last_update <', now - WAITING_TIMEOUT)
+    query.order('-last_update')
+    waiting = query.fetch(REAP_BATCH_SIZE)
+    db.delete(waiting)
+    util.bump_versions(*['game:%d' % key.id() for key in waiting])
+
+    query = Game.all()
+    query.filter('state =', 'playing')
+    query.filter('last_update <', now - PLAYING_TIMEOUT)
+    query.order('-last_update')
+    playing = query.fetch(REAP_BATCH_SIZE)
+    for game in playing:
+        game.state = 'aborted'
+        game.finished = True
+        game.turn = -1
+        game.last_update = now
+    db.put(playing)
+    # Only games that were reaped change the lobby.
+    if waiting or playing:
+        Lobby.clear()
+        Lobby.bump(set(pkey for game in playing for pkey in game.players))
+    for game in playing:
+        game.publish()
+
+    if (len(waiting) == REAP_BATCH_SIZE or
+        len(playing) == REAP_BATCH_SIZE):
+        util.defer(reap_games)
+
+RESERVE_BATCH_SIZE = 100
+
+def reserve_nicknames(cursor = None):
+    """Reserves the nicknames of registered players that were created before
+    nicknames were reserved (see Nickname.) Until it has run, nicknames are
+    reserved when they're first looked up. Needs to be run once, for example
+    by deferring it from a remote API shell.
+
+    Handles one batch of players per call, then queues itself to continue where
+    it left off.
+    """
+    query = Player.all()
+    query.filter('user =', users.User('player@mnk'))
+    if cursor: query.with_cursor(cursor)
+
+    players = query.fetch(RESERVE_BATCH_SIZE)
+    for player in players:
+        # Goes through the same choice between players that have the same
+        # nickname as logging in does.
+        owner = Nickname.lookup(player.nickname)
+        if owner and owner.key() != player.key():
+            logging.warning('Nickname %r is used by more than one player.',
+                            player.nickname)
+
+    if len(players) == RESERVE_BATCH_SIZE:
+        util.defer(reserve_nicknames, query.cursor())
+
+FINISH_BATCH_SIZE = 100
+
+def mark_finished_games(states = ('aborted', 'draw', 'win'), cursor = None):
+    """Sets the 'finished' property of completed games that were stored before
+    it was introduced, so that they're listed in the history of their players.
+    Needs to be run once, for example by deferring it from a remote API shell.
+
+    Handles one batch of games per call, then queues itself to continue where
+    it left off.
+    """
+    query = Game.all()
+    query.filter('state =', states[0])
+    if cursor: query.with_cursor(cursor)
+
+    games = query.fetch(FINISH_BATCH_SIZE)
+    unmarked = [game for game in games if not game.finished]
+    for game in unmarked:
+        game.finished = True
+    # The games are completed, so they don't change anymore and there is no
+    # need to go through Game.put.
+    db.put(unmarked)
+    Lobby.bump(set(pkey for game in unmarked for pkey in game.players))
+
+    if len(games) == FINISH_BATCH_SIZE:
+        util.defer(mark_finished_games, states, query.cursor())
+    elif len(states) > 1:
+        util.defer(mark_finished_games, states[1:])
@@ -102,15 +102,15 @@ is a subset of YAML, so it may be used as a serializer for that as well.
 __version__ = '1.9.1'
 __all__ = [
     'dump', 'dumps', 'load', 'loads',
-    'JSONDecoder', 'JSONEncoder',
+    'JSONDecoder', 'JSONEncoder', 'RawJSON',
 ]
 
 if __name__ == '__main__':
     from simplejson.decoder import JSONDecoder
-    from simplejson.encoder import JSONEncoder
+    from simplejson.encoder import JSONEncoder, RawJSON
 else:
     from decoder import JSONDecoder
-    from encoder import JSONEncoder
+    from encoder import JSONEncoder, RawJSON
 
 _default_encoder = JSONEncoder(
     skipkeys=False,
@@ -248,7 +248,8 @@ join_list_unicode(PyObject *lst)
 }
 
 static PyObject *
-scanstring_str(PyObject *pystr, Py_ssize_t end, char *encoding, int strict)
+scanstring_str(PyObject *pystr, Py_ssize_t end, char *encoding, int strict,
+               Py_ssize_t *next_end)
 {
     PyObject *rval;
     Py_ssize_t len = PyString_GET_SIZE(pystr);
@@ -356,10 +357,12 @@ scanstring_str(PyObject *pystr, Py_ssize_t end, char *encoding, int strict)
                 if (end + 6 >= len) {
                     raise_errmsg("Invalid \\uXXXX\\uXXXX surrogate pair", pystr,
                         end - 5);
+                    goto bail;
                 }
                 if (buf[next++] != '\\' || buf[next++] != 'u') {
                     raise_errmsg("Invalid \\uXXXX\\uXXXX surrogate pair", pystr,
                         end - 5);
+                    goto bail;
                 }
                 end += 6;
                 /* Decode 4 hex digits */
@@ -400,12 +403,8 @@ scanstring_str(PyObject *pystr, Py_ssize_t end, char *encoding, int strict)
         goto bail;
     }
     Py_DECREF(chunks);
-    chunks = NULL;
-#if PY_VERSION_HEX < 0x02050000 
-    return Py_BuildValue("(Ni)", rval, end);
-#else
-    return Py_BuildValue("(Nn)", rval, end);
-#endif
+    *next_end = end;
+    return rval;
 bail:
     Py_XDECREF(chunks);
     return NULL;
@@ -413,7 +412,8 @@ bail:
 
 
 static PyObject *
-scanstring_unicode(PyObject *pystr, Py_ssize_t end, int strict)
+scanstring_unicode(PyObject *pystr, Py_ssize_t end, int strict,
+                   Py_ssize_t *next_end)
 {
     PyObject *rval;
     Py_ssize_t len = PyUnicode_GET_SIZE(pystr);
@@ -516,10 +516,12 @@ scanstring_unicode(PyObject *pystr, Py_ssize_t end, int strict)
                 if (end + 6 >= len) {
                     raise_errmsg("Invalid \\uXXXX\\uXXXX surrogate pair", pystr,
                         end - 5);
+                    goto bail;
                 }
                 if (buf[next++] != '\\' || buf[next++] != 'u') {
                     raise_errmsg("Invalid \\uXXXX\\uXXXX surrogate pair", pystr,
                         end - 5);
+                    goto bail;
                 }
                 end += 6;
                 /* Decode 4 hex digits */
@@ -560,12 +562,8 @@ scanstring_unicode(PyObject *pystr, Py_ssize_t end, int strict)
         goto bail;
     }
     Py_DECREF(chunks);
-    chunks = NULL;
-#if PY_VERSION_HEX < 0x02050000 
-    return Py_BuildValue("(Ni)", rval, end);
-#else
-    return Py_BuildValue("(Nn)", rval, end);
-#endif
+    *next_end = end;
+    return rval;
 bail:
     Py_XDECREF(chunks);
     return NULL;
@@ -581,7 +579,9 @@ static PyObject *
 py_scanstring(PyObject* self UNUSED, PyObject *args)
 {
     PyObject *pystr;
+    PyObject *rval;
     Py_ssize_t end;
+    Py_ssize_t next_end = -1;
     char *encoding = NULL;
     int strict = 0;
 #if PY_VERSION_HEX < 0x02050000 
@@ -595,13 +595,23 @@ py_scanstring(PyObject* self UNUSED, PyObject *args)
         encoding = DEFAULT_ENCODING;
     }
     if (PyString_Check(pystr)) {
-        return scanstring_str(pystr, end, encoding, strict);
+        rval = scanstring_str(pystr, end, encoding, strict, &next_end);
     }
     else if (PyUnicode_Check(pystr)) {
-        return scanstring_unicode(pystr, end, strict);
+        rval = scanstring_unicode(pystr, end, strict, &next_end);
     }
-    PyErr_SetString(PyExc_TypeError, "first argument must be a string");
-    return NULL;
+    else {
+        PyErr_SetString(PyExc_TypeError, "first argument must be a string");
+        return NULL;
+    }
+    if (rval == NULL) {
+        return NULL;
+    }
+#if PY_VERSION_HEX < 0x02050000 
+    return Py_BuildValue("(Ni)", rval, next_end);
+#else
+    return Py_BuildValue("(Nn)", rval, next_end);
+#endif
 }
 
 PyDoc_STRVAR(pydoc_encode_basestring_ascii,
@@ -624,6 +634,1235 @@ py_encode_basestring_ascii(PyObject* self UNUSED, PyObject *pystr)
     return NULL;
 }
 
+/*
+ * Scanner
+ *
+ * Parses a JSON document the same way as the regex based scanner in
+ * decoder.py, calling Python only for the object_hook and parse_* functions
+ * of the decoder. Used by JSONDecoder.raw_decode (see decoder.py.)
+ */
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *encoding;
+    PyObject *object_hook;
+    PyObject *parse_float;
+    PyObject *parse_int;
+    PyObject *parse_constant;
+    int strict;
+} PyScannerObject;
+
+/* The document being scanned, which is either a str or a unicode object. */
+typedef struct {
+    PyObject *pystr;
+    const char *str;
+    const Py_UNICODE *ustr;
+    Py_ssize_t len;
+} ScannerInput;
+
+#define INPUT_CHAR(in, i) ((in)->str != NULL ? \
+    (Py_UNICODE)(unsigned char)(in)->str[i] : (in)->ustr[i])
+#define IS_DIGIT(c) (c >= '0' && c <= '9')
+/* The same characters as \s in the Python scanner, which doesn't use
+   re.UNICODE. */
+#define IS_WHITESPACE(c) (c == ' ' || c == '\t' || c == '\n' || c == '\r' || \
+    c == '\f' || c == '\v')
+
+static PyObject *
+scan_once(PyScannerObject *s, ScannerInput *in, Py_ssize_t idx,
+          Py_ssize_t *next_idx);
+
+static Py_ssize_t
+input_skip_whitespace(ScannerInput *in, Py_ssize_t idx)
+{
+    while (idx < in->len && IS_WHITESPACE(INPUT_CHAR(in, idx))) {
+        idx++;
+    }
+    return idx;
+}
+
+static Py_UNICODE
+input_next_char(ScannerInput *in, Py_ssize_t idx)
+{
+    /* Returns the character at idx, or 0 at the end of the document, which
+       is never one of the characters the scanner looks for. */
+    return idx < in->len ? INPUT_CHAR(in, idx) : 0;
+}
+
+static int
+input_startswith(ScannerInput *in, Py_ssize_t idx, const char *text,
+                 Py_ssize_t len)
+{
+    Py_ssize_t i;
+    if (idx + len > in->len) {
+        return 0;
+    }
+    for (i = 0; i < len; i++) {
+        if (INPUT_CHAR(in, idx + i) != (Py_UNICODE)text[i]) {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+static PyObject *
+input_slice(ScannerInput *in, Py_ssize_t start, Py_ssize_t end)
+{
+    /* Returns part of the document as an object of the same type. */
+    if (in->str != NULL) {
+        return PyString_FromStringAndSize(in->str + start, end - start);
+    }
+    return PyUnicode_FromUnicode(in->ustr + start, end - start);
+}
+
+static PyObject *
+scanner_stop(void)
+{
+    /* Nothing matched, which the Python scanner reports by stopping. */
+    PyErr_SetNone(PyExc_StopIteration);
+    return NULL;
+}
+
+static PyObject *
+scanner_scan_value(PyScannerObject *s, ScannerInput *in, Py_ssize_t idx,
+                   Py_ssize_t *next_idx, const char *what)
+{
+    /* Scans a value inside an array or object. */
+    PyObject *rval = scan_once(s, in, idx, next_idx);
+    if (rval == NULL && PyErr_ExceptionMatches(PyExc_StopIteration)) {
+        PyErr_Clear();
+        raise_errmsg((char *)what, in->pystr, idx);
+    }
+    return rval;
+}
+
+static PyObject *
+scanner_parse_string(PyScannerObject *s, ScannerInput *in, Py_ssize_t idx,
+                     Py_ssize_t *next_idx)
+{
+    /* idx is the index after the opening quote. */
+    if (in->str != NULL) {
+        return scanstring_str(in->pystr, idx,
+                              PyString_AS_STRING(s->encoding), s->strict,
+                              next_idx);
+    }
+    return scanstring_unicode(in->pystr, idx, s->strict, next_idx);
+}
+
+static PyObject *
+scanner_parse_object(PyScannerObject *s, ScannerInput *in, Py_ssize_t idx,
+                     Py_ssize_t *next_idx)
+{
+    /* idx is the index after the opening brace. */
+    PyObject *rval;
+    PyObject *key = NULL;
+    PyObject *value = NULL;
+    Py_UNICODE c;
+
+    rval = PyDict_New();
+    if (rval == NULL) {
+        return NULL;
+    }
+    idx = input_skip_whitespace(in, idx);
+    c = input_next_char(in, idx);
+    /* Trivial empty object, which isn't passed to object_hook. */
+    if (c == '}') {
+        *next_idx = idx + 1;
+        return rval;
+    }
+    if (c != '"') {
+        raise_errmsg("Expecting property name", in->pystr, idx);
+        goto bail;
+    }
+    idx++;
+    while (1) {
+        key = scanner_parse_string(s, in, idx, &idx);
+        if (key == NULL) {
+            goto bail;
+        }
+        idx = input_skip_whitespace(in, idx);
+        if (input_next_char(in, idx) != ':') {
+            raise_errmsg("Expecting : delimiter", in->pystr, idx);
+            goto bail;
+        }
+        idx = input_skip_whitespace(in, idx + 1);
+        value = scanner_scan_value(s, in, idx, &idx, "Expecting object");
+        if (value == NULL || PyDict_SetItem(rval, key, value)) {
+            goto bail;
+        }
+        Py_CLEAR(key);
+        Py_CLEAR(value);
+        idx = input_skip_whitespace(in, idx);
+        c = input_next_char(in, idx);
+        idx++;
+        if (c == '}') {
+            break;
+        }
+        if (c != ',') {
+            raise_errmsg("Expecting , delimiter", in->pystr, idx - 1);
+            goto bail;
+        }
+        idx = input_skip_whitespace(in, idx);
+        c = input_next_char(in, idx);
+        idx++;
+        if (c != '"') {
+            raise_errmsg("Expecting property name", in->pystr, idx - 1);
+            goto bail;
+        }
+    }
+    if (s->object_hook != Py_None) {
+        value = PyObject_CallFunctionObjArgs(s->object_hook, rval, NULL);
+        Py_DECREF(rval);
+        rval = value;
+    }
+    *next_idx = idx;
+    return rval;
+
+bail:
+    Py_XDECREF(key);
+    Py_XDECREF(value);
+    Py_DECREF(rval);
+    return NULL;
+}
+
+static PyObject *
+scanner_parse_array(PyScannerObject *s, ScannerInput *in, Py_ssize_t idx,
+                    Py_ssize_t *next_idx)
+{
+    /* idx is the index after the opening bracket. */
+    PyObject *rval;
+    PyObject *value;
+    Py_UNICODE c;
+
+    rval = PyList_New(0);
+    if (rval == NULL) {
+        return NULL;
+    }
+    idx = input_skip_whitespace(in, idx);
+    /* Trivial empty array */
+    if (input_next_char(in, idx) == ']') {
+        *next_idx = idx + 1;
+        return rval;
+    }
+    while (1) {
+        value = scanner_scan_value(s, in, idx, &idx, "Expecting object");
+        if (value == NULL) {
+            goto bail;
+        }
+        if (PyList_Append(rval, value)) {
+            Py_DECREF(value);
+            goto bail;
+        }
+        Py_DECREF(value);
+        idx = input_skip_whitespace(in, idx);
+        c = input_next_char(in, idx);
+        idx++;
+        if (c == ']') {
+            break;
+        }
+        if (c != ',') {
+            raise_errmsg("Expecting , delimiter", in->pystr, idx);
+            goto bail;
+        }
+        idx = input_skip_whitespace(in, idx);
+    }
+    *next_idx = idx;
+    return rval;
+
+bail:
+    Py_DECREF(rval);
+    return NULL;
+}
+
+static PyObject *
+scanner_parse_constant(PyScannerObject *s, ScannerInput *in, Py_ssize_t idx,
+                       Py_ssize_t len, PyObject *value, Py_ssize_t *next_idx)
+{
+    /* Returns value (a new reference) for the constant at idx, or the result
+       of parse_constant if the decoder has one. */
+    PyObject *name;
+    *next_idx = idx + len;
+    if (s->parse_constant == Py_None) {
+        return value;
+    }
+    Py_XDECREF(value);
+    name = input_slice(in, idx, idx + len);
+    if (name == NULL) {
+        return NULL;
+    }
+    value = PyObject_CallFunctionObjArgs(s->parse_constant, name, NULL);
+    Py_DECREF(name);
+    return value;
+}
+
+static PyObject *
+scanner_parse_number(PyScannerObject *s, ScannerInput *in, Py_ssize_t start,
+                     Py_ssize_t *next_idx)
+{
+    /* Matches -?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)? at start. */
+    Py_ssize_t idx = start;
+    Py_ssize_t exp;
+    int is_float = 0;
+    PyObject *numstr;
+    PyObject *rval;
+
+    if (input_next_char(in, idx) == '-') {
+        idx++;
+    }
+    if (input_next_char(in, idx) == '0') {
+        idx++;
+    }
+    else if (input_next_char(in, idx) >= '1' &&
+             input_next_char(in, idx) <= '9') {
+        idx++;
+        while (idx < in->len && IS_DIGIT(INPUT_CHAR(in, idx))) {
+            idx++;
+        }
+    }
+    else {
+        return scanner_stop();
+    }
+    if (input_next_char(in, idx) == '.' &&
+            idx + 1 < in->len && IS_DIGIT(INPUT_CHAR(in, idx + 1))) {
+        is_float = 1;
+        idx += 2;
+        while (idx < in->len && IS_DIGIT(INPUT_CHAR(in, idx))) {
+            idx++;
+        }
+    }
+    if (input_next_char(in, idx) == 'e' || input_next_char(in, idx) == 'E') {
+        exp = idx + 1;
+        if (input_next_char(in, exp) == '-' ||
+                input_next_char(in, exp) == '+') {
+            exp++;
+        }
+        if (exp < in->len && IS_DIGIT(INPUT_CHAR(in, exp))) {
+            is_float = 1;
+            idx = exp + 1;
+            while (idx < in->len && IS_DIGIT(INPUT_CHAR(in, idx))) {
+                idx++;
+            }
+        }
+    }
+    *next_idx = idx;
+
+    /* Small integers, such as the tiles of a board, don't need a string. */
+    if (!is_float && s->parse_int == Py_None && idx - start <= 9) {
+        long value = 0;
+        Py_ssize_t i = start;
+        if (INPUT_CHAR(in, i) == '-') {
+            i++;
+        }
+        for (; i < idx; i++) {
+            value = value * 10 + (INPUT_CHAR(in, i) - '0');
+        }
+        return PyInt_FromLong(INPUT_CHAR(in, start) == '-' ? -value : value);
+    }
+
+    numstr = input_slice(in, start, idx);
+    if (numstr == NULL) {
+        return NULL;
+    }
+    if (is_float) {
+        if (s->parse_float == Py_None) {
+            rval = PyFloat_FromString(numstr, NULL);
+        }
+        else {
+            rval = PyObject_CallFunctionObjArgs(s->parse_float, numstr, NULL);
+        }
+    }
+    else if (s->parse_int == Py_None) {
+        rval = PyNumber_Int(numstr);
+    }
+    else {
+        rval = PyObject_CallFunctionObjArgs(s->parse_int, numstr, NULL);
+    }
+    Py_DECREF(numstr);
+    return rval;
+}
+
+static PyObject *
+scan_once(PyScannerObject *s, ScannerInput *in, Py_ssize_t idx,
+          Py_ssize_t *next_idx)
+{
+    /* Scans the value at idx, trying the same patterns in the same order as
+       the Python scanner. */
+    PyObject *rval;
+    if (idx >= in->len) {
+        return scanner_stop();
+    }
+    switch (INPUT_CHAR(in, idx)) {
+        case '"':
+            return scanner_parse_string(s, in, idx + 1, next_idx);
+        case '{':
+        case '[':
+            if (Py_EnterRecursiveCall(" while decoding a JSON document")) {
+                return NULL;
+            }
+            if (INPUT_CHAR(in, idx) == '{') {
+                rval = scanner_parse_object(s, in, idx + 1, next_idx);
+            }
+            else {
+                rval = scanner_parse_array(s, in, idx + 1, next_idx);
+            }
+            Py_LeaveRecursiveCall();
+            return rval;
+        case 'n':
+            if (input_startswith(in, idx, "null", 4)) {
+                Py_INCREF(Py_None);
+                return scanner_parse_constant(s, in, idx, 4, Py_None,
+                                              next_idx);
+            }
+            break;
+        case 't':
+            if (input_startswith(in, idx, "true", 4)) {
+                Py_INCREF(Py_True);
+                return scanner_parse_constant(s, in, idx, 4, Py_True,
+                                              next_idx);
+            }
+            break;
+        case 'f':
+            if (input_startswith(in, idx, "false", 5)) {
+                Py_INCREF(Py_False);
+                return scanner_parse_constant(s, in, idx, 5, Py_False,
+                                              next_idx);
+            }
+            break;
+        case 'N':
+            if (input_startswith(in, idx, "NaN", 3)) {
+                return scanner_parse_constant(s, in, idx, 3,
+                    PyFloat_FromDouble(Py_NAN), next_idx);
+            }
+            break;
+        case 'I':
+            if (input_startswith(in, idx, "Infinity", 8)) {
+                return scanner_parse_constant(s, in, idx, 8,
+                    PyFloat_FromDouble(Py_HUGE_VAL), next_idx);
+            }
+            break;
+        case '-':
+            if (input_startswith(in, idx, "-Infinity", 9)) {
+                return scanner_parse_constant(s, in, idx, 9,
+                    PyFloat_FromDouble(-Py_HUGE_VAL), next_idx);
+            }
+            break;
+    }
+    return scanner_parse_number(s, in, idx, next_idx);
+}
+
+static PyObject *
+scanner_call(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    /* Scans the value at idx, returning it and the index after it. */
+    static char *kwlist[] = {"string", "idx", NULL};
+    PyScannerObject *s = (PyScannerObject *)self;
+    ScannerInput in;
+    PyObject *pystr;
+    PyObject *rval;
+    Py_ssize_t idx;
+    Py_ssize_t next_idx = -1;
+
+#if PY_VERSION_HEX < 0x02050000
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Oi:scan_once", kwlist,
+                                     &pystr, &idx)) {
+#else
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "On:scan_once", kwlist,
+                                     &pystr, &idx)) {
+#endif
+        return NULL;
+    }
+    if (idx < 0) {
+        PyErr_SetString(PyExc_ValueError, "idx cannot be negative");
+        return NULL;
+    }
+    in.pystr = pystr;
+    if (PyString_Check(pystr)) {
+        in.str = PyString_AS_STRING(pystr);
+        in.ustr = NULL;
+        in.len = PyString_GET_SIZE(pystr);
+    }
+    else if (PyUnicode_Check(pystr)) {
+        in.str = NULL;
+        in.ustr = PyUnicode_AS_UNICODE(pystr);
+        in.len = PyUnicode_GET_SIZE(pystr);
+    }
+    else {
+        PyErr_SetString(PyExc_TypeError, "first argument must be a string");
+        return NULL;
+    }
+    rval = scan_once(s, &in, idx, &next_idx);
+    if (rval == NULL) {
+        return NULL;
+    }
+#if PY_VERSION_HEX < 0x02050000
+    return Py_BuildValue("(Ni)", rval, next_idx);
+#else
+    return Py_BuildValue("(Nn)", rval, next_idx);
+#endif
+}
+
+static PyObject *
+scanner_getattr(PyObject *context, char *name)
+{
+    /* Returns getattr(context, name, None). */
+    PyObject *rval = PyObject_GetAttrString(context, name);
+    if (rval == NULL && PyErr_ExceptionMatches(PyExc_AttributeError)) {
+        PyErr_Clear();
+        Py_INCREF(Py_None);
+        rval = Py_None;
+    }
+    return rval;
+}
+
+static PyObject *
+scanner_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"context", NULL};
+    PyScannerObject *s;
+    PyObject *context;
+    PyObject *encoding;
+    PyObject *strict;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O:make_scanner", kwlist,
+                                     &context)) {
+        return NULL;
+    }
+    s = (PyScannerObject *)type->tp_alloc(type, 0);
+    if (s == NULL) {
+        return NULL;
+    }
+
+    encoding = scanner_getattr(context, "encoding");
+    if (encoding == Py_None) {
+        Py_DECREF(encoding);
+        encoding = PyString_FromString(DEFAULT_ENCODING);
+    }
+    else if (encoding != NULL && PyUnicode_Check(encoding)) {
+        PyObject *str = PyUnicode_AsASCIIString(encoding);
+        Py_DECREF(encoding);
+        encoding = str;
+    }
+    else if (encoding != NULL && !PyString_Check(encoding)) {
+        PyErr_SetString(PyExc_TypeError, "encoding must be a string");
+        Py_CLEAR(encoding);
+    }
+    s->encoding = encoding;
+    if (s->encoding == NULL) {
+        goto bail;
+    }
+
+    /* strict defaults to True when the context doesn't have it. */
+    strict = PyObject_GetAttrString(context, "strict");
+    if (strict == NULL) {
+        if (!PyErr_ExceptionMatches(PyExc_AttributeError)) {
+            goto bail;
+        }
+        PyErr_Clear();
+        s->strict = 1;
+    }
+    else {
+        s->strict = PyObject_IsTrue(strict);
+        Py_DECREF(strict);
+        if (s->strict == -1) {
+            goto bail;
+        }
+    }
+
+    s->object_hook = scanner_getattr(context, "object_hook");
+    if (s->object_hook == NULL) {
+        goto bail;
+    }
+    s->parse_float = scanner_getattr(context, "parse_float");
+    if (s->parse_float == NULL) {
+        goto bail;
+    }
+    s->parse_int = scanner_getattr(context, "parse_int");
+    if (s->parse_int == NULL) {
+        goto bail;
+    }
+    s->parse_constant = scanner_getattr(context, "parse_constant");
+    if (s->parse_constant == NULL) {
+        goto bail;
+    }
+    return (PyObject *)s;
+
+bail:
+    Py_DECREF(s);
+    return NULL;
+}
+
+static int
+scanner_traverse(PyObject *self, visitproc visit, void *arg)
+{
+    PyScannerObject *s = (PyScannerObject *)self;
+    Py_VISIT(s->encoding);
+    Py_VISIT(s->object_hook);
+    Py_VISIT(s->parse_float);
+    Py_VISIT(s->parse_int);
+    Py_VISIT(s->parse_constant);
+    return 0;
+}
+
+static int
+scanner_clear(PyObject *self)
+{
+    PyScannerObject *s = (PyScannerObject *)self;
+    Py_CLEAR(s->encoding);
+    Py_CLEAR(s->object_hook);
+    Py_CLEAR(s->parse_float);
+    Py_CLEAR(s->parse_int);
+    Py_CLEAR(s->parse_constant);
+    return 0;
+}
+
+static void
+scanner_dealloc(PyObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    scanner_clear(self);
+    Py_TYPE(self)->tp_free(self);
+}
+
+PyDoc_STRVAR(scanner_doc,
+    "make_scanner(context)\n"
+    "\n"
+    "Returns a callable that takes a string and an index, and returns the\n"
+    "JSON value at the index and the index after it, or raises StopIteration\n"
+    "if there's no value there. The encoding, strict, object_hook,\n"
+    "parse_float, parse_int and parse_constant attributes of context are\n"
+    "used like the Python scanner uses them."
+);
+
+static PyTypeObject PyScannerType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                    /* tp_internal */
+    "simplejson._speedups.Scanner",  /* tp_name */
+    sizeof(PyScannerObject), /* tp_basicsize */
+    0,                    /* tp_itemsize */
+    scanner_dealloc,      /* tp_dealloc */
+    0,                    /* tp_print */
+    0,                    /* tp_getattr */
+    0,                    /* tp_setattr */
+    0,                    /* tp_compare */
+    0,                    /* tp_repr */
+    0,                    /* tp_as_number */
+    0,                    /* tp_as_sequence */
+    0,                    /* tp_as_mapping */
+    0,                    /* tp_hash */
+    scanner_call,         /* tp_call */
+    0,                    /* tp_str */
+    0,                    /* tp_getattro */
+    0,                    /* tp_setattro */
+    0,                    /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC, /* tp_flags */
+    scanner_doc,          /* tp_doc */
+    scanner_traverse,     /* tp_traverse */
+    scanner_clear,        /* tp_clear */
+    0,                    /* tp_richcompare */
+    0,                    /* tp_weaklistoffset */
+    0,                    /* tp_iter */
+    0,                    /* tp_iternext */
+    0,                    /* tp_methods */
+    0,                    /* tp_members */
+    0,                    /* tp_getset */
+    0,                    /* tp_base */
+    0,                    /* tp_dict */
+    0,                    /* tp_descr_get */
+    0,                    /* tp_descr_set */
+    0,                    /* tp_dictoffset */
+    0,                    /* tp_init */
+    0,                    /* tp_alloc */
+    scanner_new,          /* tp_new */
+    0,                    /* tp_free */
+};
+
+/*
+ * Encoder
+ *
+ * Encodes dicts, lists, tuples, strings, numbers, booleans, None and RawJSON
+ * without going through Python, and calls a Python function for anything
+ * else. Used by JSONEncoder.iterencode when the options allow it (see
+ * encoder.py.)
+ */
+
+#define ENCODER_BLOCK_SIZE 8192
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *markers;
+    PyObject *defaultfn;
+    PyObject *floatstr;
+    PyObject *key_separator;
+    PyObject *item_separator;
+    PyObject *allow_nan;
+    PyObject *raw_json;
+    int sort_keys;
+    int skipkeys;
+} PyEncoderObject;
+
+/* The output of a call to an encoder: a list of str blocks of up to
+   ENCODER_BLOCK_SIZE bytes (and of any unicode chunks returned by the
+   default function), which join into the JSON document. */
+typedef struct {
+    PyObject *chunks;
+    char buf[ENCODER_BLOCK_SIZE];
+    Py_ssize_t len;
+} EncoderOutput;
+
+static int
+encoder_encode(PyEncoderObject *s, EncoderOutput *out, PyObject *o);
+
+static int
+output_flush(EncoderOutput *out)
+{
+    PyObject *block;
+    int rval;
+    if (out->len == 0) {
+        return 0;
+    }
+    block = PyString_FromStringAndSize(out->buf, out->len);
+    if (block == NULL) {
+        return -1;
+    }
+    out->len = 0;
+    rval = PyList_Append(out->chunks, block);
+    Py_DECREF(block);
+    return rval;
+}
+
+static int
+output_write(EncoderOutput *out, const char *str, Py_ssize_t len)
+{
+    if (len > ENCODER_BLOCK_SIZE - out->len) {
+        if (output_flush(out)) {
+            return -1;
+        }
+        if (len > ENCODER_BLOCK_SIZE) {
+            PyObject *block = PyString_FromStringAndSize(str, len);
+            int rval;
+            if (block == NULL) {
+                return -1;
+            }
+            rval = PyList_Append(out->chunks, block);
+            Py_DECREF(block);
+            return rval;
+        }
+    }
+    memcpy(out->buf + out->len, str, len);
+    out->len += len;
+    return 0;
+}
+
+static int
+output_write_object(EncoderOutput *out, PyObject *chunk)
+{
+    /* Writes a chunk returned from Python, which is normally a str. Unicode
+       chunks are kept as they are so that joining the output has the same
+       result as joining the chunks of the Python encoder. */
+    if (PyString_Check(chunk)) {
+        return output_write(out, PyString_AS_STRING(chunk),
+                            PyString_GET_SIZE(chunk));
+    }
+    if (output_flush(out)) {
+        return -1;
+    }
+    return PyList_Append(out->chunks, chunk);
+}
+
+static int
+output_write_steal(EncoderOutput *out, PyObject *chunk)
+{
+    int rval;
+    if (chunk == NULL) {
+        return -1;
+    }
+    rval = output_write_object(out, chunk);
+    Py_DECREF(chunk);
+    return rval;
+}
+
+static int
+output_write_string(EncoderOutput *out, PyObject *pystr)
+{
+    if (PyString_Check(pystr)) {
+        return output_write_steal(out, ascii_escape_str(pystr));
+    }
+    return output_write_steal(out, ascii_escape_unicode(pystr));
+}
+
+static int
+encoder_mark(PyEncoderObject *s, PyObject *o, PyObject **ident)
+{
+    /* Adds o to the markers, like JSONEncoder does, raising ValueError if it
+       is already being encoded. */
+    int has_key;
+    *ident = NULL;
+    if (s->markers == Py_None) {
+        return 0;
+    }
+    *ident = PyLong_FromVoidPtr(o);
+    if (*ident == NULL) {
+        return -1;
+    }
+    has_key = PyDict_Contains(s->markers, *ident);
+    if (has_key) {
+        if (has_key != -1) {
+            PyErr_SetString(PyExc_ValueError, "Circular reference detected");
+        }
+        Py_CLEAR(*ident);
+        return -1;
+    }
+    if (PyDict_SetItem(s->markers, *ident, o)) {
+        Py_CLEAR(*ident);
+        return -1;
+    }
+    return 0;
+}
+
+static int
+encoder_unmark(PyEncoderObject *s, PyObject *ident)
+{
+    int rval;
+    if (ident == NULL) {
+        return 0;
+    }
+    rval = PyDict_DelItem(s->markers, ident);
+    Py_DECREF(ident);
+    return rval;
+}
+
+static int
+encoder_encode_float(PyEncoderObject *s, EncoderOutput *out, PyObject *o)
+{
+    return output_write_steal(out, PyObject_CallFunctionObjArgs(
+        s->floatstr, o, s->allow_nan, NULL));
+}
+
+static int
+encoder_encode_raw(PyEncoderObject *s, EncoderOutput *out, PyObject *o)
+{
+    return output_write_steal(out, PyObject_GetAttrString(o, "encoded_json"));
+}
+
+static int
+encoder_encode_list(PyEncoderObject *s, EncoderOutput *out, PyObject *seq)
+{
+    PyObject *ident = NULL;
+    PyObject *fast;
+    Py_ssize_t i;
+
+    fast = PySequence_Fast(seq, "expected a list or tuple");
+    if (fast == NULL) {
+        return -1;
+    }
+    if (PySequence_Fast_GET_SIZE(fast) == 0) {
+        Py_DECREF(fast);
+        return output_write(out, "[]", 2);
+    }
+    if (encoder_mark(s, seq, &ident)) {
+        goto bail;
+    }
+    if (output_write(out, "[", 1)) {
+        goto bail;
+    }
+    for (i = 0; i < PySequence_Fast_GET_SIZE(fast); i++) {
+        if (i > 0 && output_write_object(out, s->item_separator)) {
+            goto bail;
+        }
+        if (encoder_encode(s, out, PySequence_Fast_GET_ITEM(fast, i))) {
+            goto bail;
+        }
+    }
+    Py_CLEAR(fast);
+    if (output_write(out, "]", 1)) {
+        goto bail;
+    }
+    return encoder_unmark(s, ident);
+
+bail:
+    Py_XDECREF(fast);
+    Py_XDECREF(ident);
+    return -1;
+}
+
+static PyObject *
+encoder_key(PyEncoderObject *s, PyObject *key)
+{
+    /* Returns a dict key as a string the way JSONEncoder converts it, or
+       Py_None if the key should be skipped. */
+    if (PyString_Check(key) || PyUnicode_Check(key)) {
+        Py_INCREF(key);
+        return key;
+    }
+    else if (PyFloat_Check(key)) {
+        return PyObject_CallFunctionObjArgs(s->floatstr, key, s->allow_nan,
+                                            NULL);
+    }
+    else if (PyInt_Check(key) || PyLong_Check(key)) {
+        /* Booleans are ints, so they end up here as "True" and "False". */
+        return PyObject_Str(key);
+    }
+    else if (key == Py_None) {
+        return PyString_FromString("null");
+    }
+    else if (s->skipkeys) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    else {
+        PyObject *repr = PyObject_Repr(key);
+        if (repr != NULL) {
+            PyErr_Format(PyExc_TypeError, "key %s is not a string",
+                         PyString_AS_STRING(repr));
+            Py_DECREF(repr);
+        }
+        return NULL;
+    }
+}
+
+static int
+encoder_encode_dict(PyEncoderObject *s, EncoderOutput *out, PyObject *dct)
+{
+    PyObject *ident = NULL;
+    PyObject *keys = NULL;
+    PyObject *key = NULL;
+    PyObject *value = NULL;
+    PyObject *text;
+    Py_ssize_t pos = 0;
+    Py_ssize_t i;
+    int first = 1;
+    int rval;
+
+    if (PyDict_Size(dct) == 0) {
+        return output_write(out, "{}", 2);
+    }
+    if (encoder_mark(s, dct, &ident)) {
+        return -1;
+    }
+    if (output_write(out, "{", 1)) {
+        goto bail;
+    }
+    if (s->sort_keys) {
+        keys = PyDict_Keys(dct);
+        if (keys == NULL || PyList_Sort(keys)) {
+            goto bail;
+        }
+    }
+    for (i = 0; ; i++) {
+        if (keys != NULL) {
+            if (i >= PyList_GET_SIZE(keys)) {
+                break;
+            }
+            key = PyList_GET_ITEM(keys, i);
+            value = PyDict_GetItem(dct, key);
+            if (value == NULL) {
+                PyErr_SetObject(PyExc_KeyError, key);
+                key = NULL;
+                goto bail;
+            }
+        }
+        else if (!PyDict_Next(dct, &pos, &key, &value)) {
+            key = value = NULL;
+            break;
+        }
+        /* Encoding the value may run Python code, so hold on to the item. */
+        Py_INCREF(key);
+        Py_INCREF(value);
+
+        text = encoder_key(s, key);
+        if (text == NULL) {
+            goto bail;
+        }
+        if (text == Py_None) {
+            Py_DECREF(text);
+            Py_CLEAR(key);
+            Py_CLEAR(value);
+            continue;
+        }
+        if (!first && output_write_object(out, s->item_separator)) {
+            Py_DECREF(text);
+            goto bail;
+        }
+        first = 0;
+        rval = output_write_string(out, text);
+        Py_DECREF(text);
+        if (rval || output_write_object(out, s->key_separator)) {
+            goto bail;
+        }
+        if (encoder_encode(s, out, value)) {
+            goto bail;
+        }
+        Py_CLEAR(key);
+        Py_CLEAR(value);
+    }
+    Py_CLEAR(keys);
+    if (output_write(out, "}", 1)) {
+        goto bail;
+    }
+    return encoder_unmark(s, ident);
+
+bail:
+    Py_XDECREF(key);
+    Py_XDECREF(value);
+    Py_XDECREF(keys);
+    Py_XDECREF(ident);
+    return -1;
+}
+
+static int
+encoder_encode_default(PyEncoderObject *s, EncoderOutput *out, PyObject *o)
+{
+    PyObject *ident;
+    PyObject *chunks;
+    PyObject *iter;
+    PyObject *chunk;
+
+    if (encoder_mark(s, o, &ident)) {
+        return -1;
+    }
+    chunks = PyObject_CallFunctionObjArgs(s->defaultfn, o, s->markers, NULL);
+    if (chunks == NULL) {
+        goto bail;
+    }
+    iter = PyObject_GetIter(chunks);
+    Py_DECREF(chunks);
+    if (iter == NULL) {
+        goto bail;
+    }
+    while ((chunk = PyIter_Next(iter)) != NULL) {
+        if (output_write_steal(out, chunk)) {
+            Py_DECREF(iter);
+            goto bail;
+        }
+    }
+    Py_DECREF(iter);
+    if (PyErr_Occurred()) {
+        goto bail;
+    }
+    return encoder_unmark(s, ident);
+
+bail:
+    Py_XDECREF(ident);
+    return -1;
+}
+
+static int
+encoder_encode(PyEncoderObject *s, EncoderOutput *out, PyObject *o)
+{
+    int rval;
+    if (PyString_Check(o) || PyUnicode_Check(o)) {
+        return output_write_string(out, o);
+    }
+    else if (o == Py_None) {
+        return output_write(out, "null", 4);
+    }
+    else if (o == Py_True) {
+        return output_write(out, "true", 4);
+    }
+    else if (o == Py_False) {
+        return output_write(out, "false", 5);
+    }
+    else if (PyInt_CheckExact(o)) {
+        char buf[32];
+        int len = PyOS_snprintf(buf, sizeof(buf), "%ld", PyInt_AS_LONG(o));
+        return output_write(out, buf, len);
+    }
+    else if (PyInt_Check(o) || PyLong_Check(o)) {
+        return output_write_steal(out, PyObject_Str(o));
+    }
+    else if (PyFloat_Check(o)) {
+        return encoder_encode_float(s, out, o);
+    }
+    else if (PyObject_TypeCheck(o, (PyTypeObject *)s->raw_json)) {
+        return encoder_encode_raw(s, out, o);
+    }
+
+    if (Py_EnterRecursiveCall(" while encoding a JSON object")) {
+        return -1;
+    }
+    if (PyList_Check(o) || PyTuple_Check(o)) {
+        rval = encoder_encode_list(s, out, o);
+    }
+    else if (PyDict_Check(o)) {
+        rval = encoder_encode_dict(s, out, o);
+    }
+    else {
+        rval = encoder_encode_default(s, out, o);
+    }
+    Py_LeaveRecursiveCall();
+    return rval;
+}
+
+static PyObject *
+encoder_call(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    /* Encodes an object, returning the list of chunks. */
+    static char *kwlist[] = {"obj", NULL};
+    PyEncoderObject *s = (PyEncoderObject *)self;
+    PyObject *obj;
+    EncoderOutput *out;
+    PyObject *chunks;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O:_iterencode", kwlist,
+                                     &obj)) {
+        return NULL;
+    }
+    out = (EncoderOutput *)PyMem_Malloc(sizeof(EncoderOutput));
+    if (out == NULL) {
+        return PyErr_NoMemory();
+    }
+    out->len = 0;
+    out->chunks = chunks = PyList_New(0);
+    if (chunks == NULL || encoder_encode(s, out, obj) || output_flush(out)) {
+        Py_XDECREF(chunks);
+        chunks = NULL;
+    }
+    PyMem_Free(out);
+    return chunks;
+}
+
+static PyObject *
+encoder_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"markers", "default", "floatstr",
+                             "key_separator", "item_separator", "sort_keys",
+                             "skipkeys", "allow_nan", "raw_json", NULL};
+    PyEncoderObject *s;
+    PyObject *markers, *defaultfn, *floatstr, *key_separator, *item_separator;
+    PyObject *sort_keys, *skipkeys, *allow_nan, *raw_json;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOOOOOO:make_encoder",
+                                     kwlist, &markers, &defaultfn, &floatstr,
+                                     &key_separator, &item_separator,
+                                     &sort_keys, &skipkeys, &allow_nan,
+                                     &raw_json)) {
+        return NULL;
+    }
+    if (!PyType_Check(raw_json)) {
+        PyErr_SetString(PyExc_TypeError, "raw_json must be a type");
+        return NULL;
+    }
+    if (markers != Py_None && !PyDict_Check(markers)) {
+        PyErr_SetString(PyExc_TypeError, "markers must be a dict or None");
+        return NULL;
+    }
+    s = (PyEncoderObject *)type->tp_alloc(type, 0);
+    if (s == NULL) {
+        return NULL;
+    }
+    s->sort_keys = PyObject_IsTrue(sort_keys);
+    s->skipkeys = PyObject_IsTrue(skipkeys);
+    if (s->sort_keys == -1 || s->skipkeys == -1) {
+        Py_DECREF(s);
+        return NULL;
+    }
+    Py_INCREF(markers);
+    s->markers = markers;
+    Py_INCREF(defaultfn);
+    s->defaultfn = defaultfn;
+    Py_INCREF(floatstr);
+    s->floatstr = floatstr;
+    Py_INCREF(key_separator);
+    s->key_separator = key_separator;
+    Py_INCREF(item_separator);
+    s->item_separator = item_separator;
+    Py_INCREF(allow_nan);
+    s->allow_nan = allow_nan;
+    Py_INCREF(raw_json);
+    s->raw_json = raw_json;
+    return (PyObject *)s;
+}
+
+static int
+encoder_traverse(PyObject *self, visitproc visit, void *arg)
+{
+    PyEncoderObject *s = (PyEncoderObject *)self;
+    Py_VISIT(s->markers);
+    Py_VISIT(s->defaultfn);
+    Py_VISIT(s->floatstr);
+    Py_VISIT(s->key_separator);
+    Py_VISIT(s->item_separator);
+    Py_VISIT(s->allow_nan);
+    Py_VISIT(s->raw_json);
+    return 0;
+}
+
+static int
+encoder_clear(PyObject *self)
+{
+    PyEncoderObject *s = (PyEncoderObject *)self;
+    Py_CLEAR(s->markers);
+    Py_CLEAR(s->defaultfn);
+    Py_CLEAR(s->floatstr);
+    Py_CLEAR(s->key_separator);
+    Py_CLEAR(s->item_separator);
+    Py_CLEAR(s->allow_nan);
+    Py_CLEAR(s->raw_json);
+    return 0;
+}
+
+static void
+encoder_dealloc(PyObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    encoder_clear(self);
+    Py_TYPE(self)->tp_free(self);
+}
+
+PyDoc_STRVAR(encoder_doc,
+    "make_encoder(markers, default, floatstr, key_separator, item_separator,\n"
+    "             sort_keys, skipkeys, allow_nan, raw_json)\n"
+    "\n"
+    "Returns a callable that encodes an object as JSON and returns a list of\n"
+    "chunks that join into the document. The encoded_json of instances of\n"
+    "raw_json is output as it is. Objects that aren't dicts, lists, tuples,\n"
+    "strings, numbers, booleans or None are passed to default along with\n"
+    "markers, and it should return an iterable of chunks."
+);
+
+static PyTypeObject PyEncoderType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                    /* tp_internal */
+    "simplejson._speedups.Encoder",  /* tp_name */
+    sizeof(PyEncoderObject), /* tp_basicsize */
+    0,                    /* tp_itemsize */
+    encoder_dealloc,      /* tp_dealloc */
+    0,                    /* tp_print */
+    0,                    /* tp_getattr */
+    0,                    /* tp_setattr */
+    0,                    /* tp_compare */
+    0,                    /* tp_repr */
+    0,                    /* tp_as_number */
+    0,                    /* tp_as_sequence */
+    0,                    /* tp_as_mapping */
+    0,                    /* tp_hash */
+    encoder_call,         /* tp_call */
+    0,                    /* tp_str */
+    0,                    /* tp_getattro */
+    0,                    /* tp_setattro */
+    0,                    /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC, /* tp_flags */
+    encoder_doc,          /* tp_doc */
+    encoder_traverse,     /* tp_traverse */
+    encoder_clear,        /* tp_clear */
+    0,                    /* tp_richcompare */
+    0,                    /* tp_weaklistoffset */
+    0,                    /* tp_iter */
+    0,                    /* tp_iternext */
+    0,                    /* tp_methods */
+    0,                    /* tp_members */
+    0,                    /* tp_getset */
+    0,                    /* tp_base */
+    0,                    /* tp_dict */
+    0,                    /* tp_descr_get */
+    0,                    /* tp_descr_set */
+    0,                    /* tp_dictoffset */
+    0,                    /* tp_init */
+    0,                    /* tp_alloc */
+    encoder_new,          /* tp_new */
+    0,                    /* tp_free */
+};
+
 static PyMethodDef speedups_methods[] = {
     {"encode_basestring_ascii",
         (PyCFunction)py_encode_basestring_ascii,
@@ -640,5 +1879,18 @@ void
 init_speedups(void)
 {
     PyObject *m;
+    if (PyType_Ready(&PyScannerType) < 0) {
+        return;
+    }
+    if (PyType_Ready(&PyEncoderType) < 0) {
+        return;
+    }
     m = Py_InitModule4("_speedups", speedups_methods, NULL, NULL, PYTHON_API_VERSION);
+    if (m == NULL) {
+        return;
+    }
+    Py_INCREF((PyObject *)&PyScannerType);
+    PyModule_AddObject(m, "make_scanner", (PyObject *)&PyScannerType);
+    Py_INCREF((PyObject *)&PyEncoderType);
+    PyModule_AddObject(m, "make_encoder", (PyObject *)&PyEncoderType);
 }
@@ -10,6 +10,11 @@ try:
 except ImportError:
     pass
 
+try:
+    from simplejson._speedups import make_scanner as c_make_scanner
+except ImportError:
+    c_make_scanner = None
+
 FLAGS = re.VERBOSE | re.MULTILINE | re.DOTALL
 
 def _floatconstants():
@@ -335,9 +340,21 @@ class JSONDecoder(object):
         """
         kw.setdefault('context', self)
         try:
-            obj, end = self._scanner.iterscan(s, **kw).next()
+            if self._use_c_scanner():
+                scan_once = c_make_scanner(kw['context'])
+                obj, end = scan_once(s, kw.get('idx', 0))
+            else:
+                obj, end = self._scanner.iterscan(s, **kw).next()
         except StopIteration:
             raise ValueError("No JSON object could be decoded")
         return obj, end
 
+    def _use_c_scanner(self):
+        """
+        Return True if the C scanner parses documents the same way as
+        ``_scanner``, which it does unless a subclass replaces ``_scanner``.
+        """
+        return (c_make_scanner is not None
+            and self._scanner is JSONDecoder._scanner)
+
 __all__ = ['JSONDecoder']
@@ -8,6 +8,11 @@ try:
 except ImportError:
     pass
 
+try:
+    from simplejson._speedups import make_encoder as c_make_encoder
+except ImportError:
+    c_make_encoder = None
+
 ESCAPE = re.compile(r'[\x00-\x1f\\"\b\f\n\r\t]')
 ESCAPE_ASCII = re.compile(r'([\\"]|[^\ -~])')
 HAS_UTF8 = re.compile(r'[\x80-\xff]')
@@ -47,6 +52,17 @@ def floatstr(o, allow_nan=True):
     return text
 
 
+class RawJSON(object):
+    """
+    A value that has already been encoded as JSON, which is output as it is
+    by ``JSONEncoder``. The encoded JSON isn't checked in any way.
+    """
+    __slots__ = ['encoded_json']
+
+    def __init__(self, encoded_json):
+        self.encoded_json = encoded_json
+
+
 def encode_basestring(s):
     """
     Return a JSON representation of a Python string
@@ -307,6 +323,8 @@ class JSONEncoder(object):
         elif isinstance(o, dict):
             for chunk in self._iterencode_dict(o, markers):
                 yield chunk
+        elif isinstance(o, RawJSON):
+            yield o.encoded_json
         else:
             if markers is not None:
                 markerid = id(o)
@@ -380,6 +398,34 @@ class JSONEncoder(object):
             markers = {}
         else:
             markers = None
+        if self._use_c_encoder():
+            _iterencode = c_make_encoder(
+                markers, self._iterencode_default, floatstr,
+                self.key_separator, self.item_separator, self.sort_keys,
+                self.skipkeys, self.allow_nan, RawJSON)
+            return iter(_iterencode(o))
         return self._iterencode(o, markers)
 
-__all__ = ['JSONEncoder']
+    def _use_c_encoder(self):
+        """
+        Return True if the C encoder produces the same output as
+        ``_iterencode`` with the options of this encoder. It's used for
+        compact ASCII output of UTF-8 strings, unless a subclass overrides
+        how lists, dicts or values are encoded (overriding ``default`` or
+        ``_iterencode_default`` is fine, since the C encoder calls
+        ``_iterencode_default`` for other objects).
+        """
+        cls = type(self)
+        return (c_make_encoder is not None
+            and self.indent is None
+            and self.ensure_ascii
+            and self.encoding in (None, 'utf-8')
+            and isinstance(self.item_separator, str)
+            and isinstance(self.key_separator, str)
+            and cls._iterencode.im_func is JSONEncoder._iterencode.im_func
+            and cls._iterencode_list.im_func is
+                JSONEncoder._iterencode_list.im_func
+            and cls._iterencode_dict.im_func is
+                JSONEncoder._iterencode_dict.im_func)
+
+__all__ = ['JSONEncoder', 'RawJSON']
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2008-2010 Andreas Blixt <andreas@blixt.org>
+# Project homepage: <http://github.com/blixt/monkey>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Measures the cold start time of the application: the time it takes a new
+Python process to import main and respond to its first request. Each run is
+made in a fresh process so that nothing is already imported.
+
+Usage: coldstart.py [--runs N] [--path /game/] SDK_PATH
+"""
+
+import optparse, os, subprocess, sys
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh process. Prints the number of seconds until the response to
+# the first request has been written, followed by the number of modules that
+# were imported.
+CHILD = r'''
+import os, sys, time
+sys.path.insert(0, %(sdk)r)
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path.insert(0, %(root)r)
+os.chdir(%(root)r)
+before = set(sys.modules)
+
+start = time.time()
+import main
+
+status = []
+def start_response(s, headers, exc_info = None):
+    status.append(s)
+environ = {
+    'REQUEST_METHOD': 'GET',
+    'PATH_INFO': %(path)r,
+    'QUERY_STRING': '',
+    'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '80',
+    'SERVER_PROTOCOL': 'HTTP/1.1',
+    'wsgi.url_scheme': 'http',
+    'wsgi.input': sys.stdin,
+    'wsgi.errors': sys.stderr,
+}
+body = ''.join(main.application(environ, start_response))
+elapsed = time.time() - start
+
+if not status[0].startswith('200'):
+    raise SystemExit('Unexpected status: ' + status[0])
+print elapsed, len(set(sys.modules) - before)
+'''
+
+def run(sdk, path):
+    code = CHILD % { 'sdk': sdk, 'root': APP_ROOT, 'path': path }
+    env = dict(os.environ, APPLICATION_ID = 'monkey', SERVER_SOFTWARE = 'Benchmark')
+    out = subprocess.Popen([sys.executable, '-c', code], env = env,
+                           stdout = subprocess.PIPE).communicate()[0]
+    elapsed, modules = out.split()
+    return float(elapsed), int(modules)
+
+def main():
+    parser = optparse.OptionParser(usage = __doc__.strip().split('\n')[-1])
+    parser.add_option('--runs', type = 'int', default = 10,
+                      help = 'number of processes to start (default 10)')
+    parser.add_option('--path', default = '/game/',
+                      help = 'path of the first request (default /game/)')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('the path to the App Engine SDK is required')
+
+    results = [run(args[0], options.path) for i in xrange(options.runs)]
+    times = sorted(r[0] for r in results)
+
+    print 'Time to first response over %d runs:' % options.runs
+    print '  min    %7.1f ms' % (times[0] * 1000)
+    print '  median %7.1f ms' % (times[len(times) // 2] * 1000)
+    print '  max    %7.1f ms' % (times[-1] * 1000)
+    print 'Modules imported: %d' % results[-1][1]
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2008-2010 Andreas Blixt <andreas@blixt.org>
+# Project homepage: <http://github.com/blixt/monkey>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compares the peak memory used to write large responses by encoding them
+into one string first (simplejson.dumps) and by writing the chunks of
+iterencode in blocks, the way ServiceHandler does. Each measurement is made in
+a fresh process, and the peak is measured from after the payload was built.
+
+Usage: jsonmemory.py [--board SIZE] [--games COUNT]
+"""
+
+import optparse, os, subprocess, sys
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh process. Prints the growth of the peak resident set size in
+# kilobytes.
+CHILD = r'''
+import resource, sys, cStringIO
+sys.path.insert(0, %(root)r)
+import simplejson
+
+def board(size):
+    return { 'status': 'success',
+             'response': { 'players': [u'Player 1', u'Player 2'],
+                           'current_player': 1, 'state': 'playing',
+                           'turn': size * size // 2, 'rule_set_id': 1,
+                           'playing_as': 1,
+                           'board': [[(x * y) %% 3 for y in xrange(size)]
+                                     for x in xrange(size)] } }
+
+def lobby(count):
+    return { 'status': 'success',
+             'response': { 'cursor': 'MTI4MDAwMDAwMDAwMDAwMA==',
+                           'games': [{ 'id': i,
+                                       'players': [u'Player %%d' %% i, u'CPU'],
+                                       'player_keys': ['a' * 40, 'b' * 40],
+                                       'current_player': 1,
+                                       'state': 'playing',
+                                       'rule_set_id': 1,
+                                       'last_update': 1280000000.0 + i }
+                                     for i in xrange(count)] } }
+
+payload = %(payload)s
+encoder = simplejson.JSONEncoder(separators = (',', ':'))
+out = cStringIO.StringIO()
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if %(stream)r:
+    block, size = [], 0
+    for chunk in encoder.iterencode(payload):
+        block.append(chunk)
+        size += len(chunk)
+        if size >= 8192:
+            out.write(''.join(block))
+            block, size = [], 0
+    out.write(''.join(block))
+else:
+    out.write(encoder.encode(payload))
+
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print after - before, out.tell()
+'''
+
+def run(payload, stream):
+    code = CHILD % { 'root': APP_ROOT, 'payload': payload, 'stream': stream }
+    out = subprocess.Popen([sys.executable, '-c', code],
+                           stdout = subprocess.PIPE).communicate()[0]
+    growth, length = out.split()
+    return int(growth), int(length)
+
+def main():
+    parser = optparse.OptionParser(usage = __doc__.strip().split('\n')[-1])
+    parser.add_option('--board', type = 'int', default = 1000,
+                      help = 'width and height of the board (default 1000)')
+    parser.add_option('--games', type = 'int', default = 50000,
+                      help = 'number of games in the lobby (default 50000)')
+    options, args = parser.parse_args()
+
+    payloads = (
+        ('%dx%d board' % (options.board, options.board),
+         'board(%d)' % options.board),
+        ('lobby of %d games' % options.games, 'lobby(%d)' % options.games),
+    )
+    for name, payload in payloads:
+        growth, length = run(payload, False)
+        print '%s (%d bytes of JSON):' % (name, length)
+        print '  dumps      %8d KB peak growth' % growth
+        growth, length = run(payload, True)
+        print '  iterencode %8d KB peak growth' % growth
+
+if __name__ == '__main__':
+    main()
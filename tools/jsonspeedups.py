@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2008-2010 Andreas Blixt <andreas@blixt.org>
+# Project homepage: <http://github.com/blixt/monkey>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Builds the C speedups of the bundled simplejson in a temporary directory,
+checks that the C encoder and scanner produce exactly the same results as the
+pure Python code, and compares their speed.
+
+Usage: jsonspeedups.py [--number N]
+"""
+
+import glob, optparse, os, shutil, sys, tempfile, timeit
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def build(target):
+    """Copies simplejson to target and builds _speedups in it.
+    """
+    from distutils.command.build_ext import build_ext
+    from distutils.core import Distribution, Extension
+
+    package = os.path.join(target, 'simplejson')
+    os.mkdir(package)
+    for path in glob.glob(os.path.join(APP_ROOT, 'simplejson', '*.py')):
+        shutil.copy(path, package)
+
+    source = os.path.join(APP_ROOT, 'simplejson', '_speedups.c')
+    dist = Distribution({ 'ext_modules': [
+        Extension('simplejson._speedups', [source])] })
+    cmd = build_ext(dist)
+    cmd.build_lib = target
+    cmd.build_temp = os.path.join(target, 'build')
+    cmd.ensure_finalized()
+    cmd.run()
+
+class Raw(object):
+    """Stands in for objects that subclasses encode through
+    _iterencode_default."""
+    def __init__(self, json):
+        self.json = json
+
+class IntSubclass(int):
+    def __str__(self):
+        return '%d' % (self + 0)
+
+class StrSubclass(str):
+    pass
+
+def circular():
+    a = []
+    a.append(a)
+    return a
+
+board = [[(x * y) % 3 for y in xrange(19)] for x in xrange(19)]
+
+# Values to encode. Each one is also encoded as part of a list and a dict.
+VALUES = [
+    None, True, False, 0, -1, 2 ** 31, -2 ** 63, 2 ** 70, IntSubclass(5),
+    0.0, -0.0, 1.0 / 3, 1e300, 1e-300, float('nan'), float('inf'),
+    float('-inf'), '', 'abc', StrSubclass('sub'), '\x00\x1f"\\/\b\f\n\r\t',
+    '\xc3\xa9t\xc3\xa9', u'', u'\xe9\u1234\U0001d11e', u'\x7f\x80',
+    'x' * 20000, u'\u1234' * 5000, [], (), {}, [[]], {'': {}}, (1, (2, 3)),
+    range(5000), board,
+    { 'players': [u'Andreas', u'CPU'], 'current_player': 1,
+      'state': 'playing', 'turn': 42, 'rule_set_id': 7, 'board': board },
+    { 1: 'int', 2.5: 'float', True: 'bool', None: 'none', 2 ** 70: 'long',
+      u'\xe9': 'unicode', 'b': 'str' },
+    { (1, 2): 'tuple key' }, { 'a': Raw('{"raw":[1,2]}') },
+    Raw('"raw"'), Raw(u'"unicode raw"'), object(), circular(), '\xff',
+]
+
+# Options to encode with.
+OPTIONS = [
+    {}, { 'separators': (',', ':') }, { 'sort_keys': True },
+    { 'skipkeys': True }, { 'check_circular': False }, { 'allow_nan': False },
+]
+
+# Documents to decode. Each one is also decoded with surrounding whitespace and
+# as part of an array and an object.
+DOCUMENTS = [
+    'null', 'true', 'false', 'NaN', 'Infinity', '-Infinity', '0', '-0', '7',
+    '-12', '123456789', '-123456789', '1234567890', '99999999999999999999',
+    '1.5', '-0.25', '1e3', '1E+3', '2.5e-3', '1.', '1e', '1.e5', '01', '-',
+    '--1', '+1', '.5', '"abc"', '""', '"\\u00e9\\ud834\\udd1e"',
+    '"\\"\\\\\\/\\b\\f\\n\\r\\t"', '"\xc3\xa9t\xc3\xa9"',
+    u'"\xe9\u1234"', '"\\x"', '"\\u12"', '"\\ud834\\u"', '"tab\tin"',
+    '"unterminated', '[]', '[ ]', '{}', '{ }', '[1, [2, [3]], {"a": []}]',
+    '{"a": 1, "a": 2, "b": {"c": null}}', '[1,]', '[1 2]', '[', ']', '{',
+    '{"a"}', '{"a": }', '{"a": 1,}', '{"a": 1 "b": 2}', '{1: 2}', "{'a': 1}",
+    'nul', 'tru', 'Nan', 'infinity', '', ' ', '\xff', u'\u2028', '[' * 2000,
+    '[1, 2] 3', '"a" "b"', '{"players": [1, 2], "board": %s}' % (board,),
+]
+
+# Options to decode with.
+DECODE_OPTIONS = [
+    {}, { 'strict': False }, { 'encoding': 'latin-1' },
+    { 'object_hook': lambda d: sorted(d.items()) },
+    { 'parse_float': lambda s: ('float', s),
+      'parse_int': lambda s: ('int', s),
+      'parse_constant': lambda s: ('constant', s) },
+]
+
+def encode(simplejson, value, options):
+    """Returns the result of encoding a value, or the type and message of the
+    exception it raised.
+    """
+    class Encoder(simplejson.JSONEncoder):
+        def _iterencode_default(self, o, markers = None):
+            if isinstance(o, Raw): return [o.json]
+            return simplejson.JSONEncoder._iterencode_default(self, o,
+                                                              markers)
+
+    try:
+        return Encoder(**options).encode(value)
+    except RuntimeError, e:
+        # Infinite recursion is reported differently by C and Python.
+        return ('RuntimeError',)
+    except Exception, e:
+        return (e.__class__.__name__, str(e))
+
+def decode(simplejson, document, options):
+    """Returns the repr of the result of decoding a document, or the type and
+    message of the exception it raised.
+    """
+    try:
+        # The repr tells str from unicode and NaN equals itself in it.
+        return repr(simplejson.loads(document, **options))
+    except RuntimeError, e:
+        return ('RuntimeError',)
+    except Exception, e:
+        return (e.__class__.__name__, str(e))
+
+def compare_encoding(simplejson, encoder):
+    """Encodes all values with all options with and without the C encoder and
+    returns the number of differences.
+    """
+    class RawSubclass(simplejson.RawJSON):
+        pass
+
+    # Values that can only be created once simplejson has been imported.
+    values = VALUES + [simplejson.RawJSON('{"raw":[1,2]}'),
+                       simplejson.RawJSON(u'"unicode raw"'),
+                       RawSubclass('[]'), [simplejson.RawJSON('')]]
+
+    c_make_encoder = encoder.c_make_encoder
+    failures = 0
+    checks = 0
+    for options in OPTIONS:
+        for value in values:
+            for wrapped in (value, [1, value, 2], {'k': value, 'z': [value]}):
+                try:
+                    encoder.c_make_encoder = None
+                    expected = encode(simplejson, wrapped, options)
+                finally:
+                    encoder.c_make_encoder = c_make_encoder
+                actual = encode(simplejson, wrapped, options)
+
+                checks += 1
+                if actual != expected:
+                    failures += 1
+                    print 'Different output for %r with %r:' % (wrapped,
+                                                                options)
+                    print '  Python: %r' % (expected,)
+                    print '  C:      %r' % (actual,)
+    print 'Encoding: %d checks, %d differences.' % (checks, failures)
+    return failures
+
+def compare_decoding(simplejson, decoder):
+    """Decodes all documents with all options with and without the C scanner
+    and returns the number of differences.
+    """
+    c_make_scanner = decoder.c_make_scanner
+    failures = 0
+    checks = 0
+    for options in DECODE_OPTIONS:
+        for document in DOCUMENTS:
+            for wrapped in (document, ' \n%s\t ' % document,
+                            '[1, %s, 2]' % document,
+                            '{"k": %s, "z": [%s]}' % (document, document)):
+                try:
+                    decoder.c_make_scanner = None
+                    expected = decode(simplejson, wrapped, options)
+                finally:
+                    decoder.c_make_scanner = c_make_scanner
+                actual = decode(simplejson, wrapped, options)
+
+                checks += 1
+                if actual != expected:
+                    failures += 1
+                    print 'Different result for %r with %r:' % (wrapped,
+                                                                options)
+                    print '  Python: %r' % (expected,)
+                    print '  C:      %r' % (actual,)
+    print 'Decoding: %d checks, %d differences.' % (checks, failures)
+    return failures
+
+def benchmark(simplejson, encoder, decoder, number):
+    status = VALUES[VALUES.index(board) + 1]
+    lobby = [{ 'id': i, 'players': [u'Player %d' % i, u'CPU'],
+               'player_keys': ['a' * 40, 'b' * 40], 'current_player': 1,
+               'state': 'playing', 'rule_set_id': 1,
+               'last_update': 1280000000.0 + i } for i in xrange(100)]
+    e = simplejson.JSONEncoder(separators = (',', ':'))
+
+    c_make_encoder = encoder.c_make_encoder
+    for name, payload in (('19x19 status', status), ('lobby', lobby)):
+        encoder.c_make_encoder = None
+        python = timeit.timeit(lambda: e.encode(payload), number = number)
+        encoder.c_make_encoder = c_make_encoder
+        c = timeit.timeit(lambda: e.encode(payload), number = number)
+        print 'encode %-14s Python %7.1f us  C %7.1f us  (%.1fx)' % (
+            name, python / number * 1e6, c / number * 1e6, python / c)
+
+    # A batch of calls the way the client posts them, and the arguments of a
+    # single call.
+    batch = simplejson.dumps([{ 'action': 'move', 'args': { 'game': 123,
+                                                            'x': i % 19,
+                                                            'y': i // 19 } }
+                              for i in xrange(20)])
+    documents = (('19x19 status', e.encode(status)), ('lobby', e.encode(lobby)),
+                 ('batch', batch), ('argument', '"abcdef"'))
+    c_make_scanner = decoder.c_make_scanner
+    for name, document in documents:
+        decoder.c_make_scanner = None
+        python = timeit.timeit(lambda: simplejson.loads(document),
+                               number = number)
+        decoder.c_make_scanner = c_make_scanner
+        c = timeit.timeit(lambda: simplejson.loads(document), number = number)
+        print 'decode %-14s Python %7.1f us  C %7.1f us  (%.1fx)' % (
+            name, python / number * 1e6, c / number * 1e6, python / c)
+
+def main():
+    parser = optparse.OptionParser(usage = __doc__.strip().split('\n')[-1])
+    parser.add_option('--number', type = 'int', default = 2000,
+                      help = 'number of times to encode and decode each '
+                             'payload (default 2000)')
+    options, args = parser.parse_args()
+
+    target = tempfile.mkdtemp()
+    try:
+        build(target)
+        sys.path.insert(0, target)
+        import simplejson
+        from simplejson import decoder, encoder
+        if encoder.c_make_encoder is None or decoder.c_make_scanner is None:
+            raise SystemExit('The C speedups could not be imported.')
+
+        failures = (compare_encoding(simplejson, encoder) +
+                    compare_decoding(simplejson, decoder))
+        benchmark(simplejson, encoder, decoder, options.number)
+    finally:
+        shutil.rmtree(target)
+
+    sys.exit(failures and 1 or 0)
+
+if __name__ == '__main__':
+    main()
@@ -8,14 +8,19 @@
 """Utility classes and functions for Google App Engine applications.
 """
 
-import logging
+import bisect, collections, itertools, logging, os, Queue, random, sys, threading, time
 
-from google.appengine.api import users
+from google.appengine.api import memcache, quota, users
 from google.appengine.ext import webapp
 
-from google.appengine.ext.webapp import template
+try:
+    from google.appengine.ext import deferred
+except ImportError:
+    deferred = None
 
-import simplejson
+# hashlib, simplejson and the template module are imported where they're used,
+# so that requests that don't need them don't pay for loading them when an
+# instance starts.
 
 def contains(sequence, value):
     """A recursive version of the 'in' operator.
@@ -25,6 +30,488 @@ def contains(sequence, value):
             return True
     return False
 
+_local_queue = None
+_local_queue_lock = threading.Lock()
+# Names of the tasks that have been queued locally, oldest first.
+_local_names = []
+_local_names_set = set()
+_LOCAL_NAMES_SIZE = 10000
+
+def _local_worker():
+    """Runs tasks from the local task queue, one at a time.
+    """
+    while True:
+        func, args, kwargs = _local_queue.get()
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logging.exception('Background task %s%r failed.',
+                              func.__name__, args)
+
+def defer(func, *args, **kwargs):
+    """Runs a function in the background.
+
+    Uses the App Engine task queue when it's available. Otherwise, falls back
+    to a worker thread in the current process so that the function still runs
+    outside of the current request.
+
+    If a _name keyword argument is given, the function is only queued if no
+    other task has been queued with the same name. Locally, the names of the
+    most recent tasks are remembered.
+    """
+    name = kwargs.pop('_name', None)
+
+    if deferred:
+        from google.appengine.api import taskqueue
+        try:
+            deferred.defer(func, _name = name, *args, **kwargs)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+        return
+
+    global _local_queue
+    _local_queue_lock.acquire()
+    try:
+        if name:
+            if name in _local_names_set: return
+            _local_names.append(name)
+            _local_names_set.add(name)
+            if len(_local_names) > _LOCAL_NAMES_SIZE:
+                _local_names_set.discard(_local_names.pop(0))
+
+        if not _local_queue:
+            _local_queue = Queue.Queue()
+            worker = threading.Thread(target = _local_worker)
+            worker.setDaemon(True)
+            worker.start()
+    finally:
+        _local_queue_lock.release()
+
+    _local_queue.put((func, args, kwargs))
+
+def is_development():
+    """Returns True if the application is running on the development server.
+    """
+    return os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+_scheduled = set()
+_scheduled_lock = threading.Lock()
+
+def every(seconds, func):
+    """Calls a function at a fixed interval from a thread in the current
+    process. Intended as a stand-in for cron jobs where they don't run, such as
+    on the development server.
+
+    Scheduling the same function more than once has no effect.
+    """
+    _scheduled_lock.acquire()
+    try:
+        if func in _scheduled: return
+        _scheduled.add(func)
+    finally:
+        _scheduled_lock.release()
+
+    def loop():
+        while True:
+            time.sleep(seconds)
+            try:
+                func()
+            except Exception:
+                logging.exception('Scheduled task %s failed.', func.__name__)
+
+    thread = threading.Thread(target = loop)
+    thread.setDaemon(True)
+    thread.start()
+
+def bump_versions(*keys):
+    """Changes the versions returned by get_version for the specified keys.
+    """
+    memcache.delete_multi(keys, key_prefix = 'version:')
+
+def get_version(key):
+    """Returns an opaque string that stays the same until bump_versions is
+    called for the key. Useful for telling whether something has changed
+    without looking at it.
+    """
+    version = memcache.get('version:' + key)
+    if version is None:
+        version = '%x' % random.getrandbits(64)
+        if not memcache.add('version:' + key, version):
+            version = memcache.get('version:' + key) or version
+    return version
+
+class _Channel(object):
+    """The state of a notifier channel within an instance."""
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.version = None
+        self.message = None
+        self.waiters = 0
+        self.checked = 0
+
+class LocalNotifier(object):
+    """Lets requests wait for the version of a channel (for example, the turn
+    of a game) to change. Each version can come with a message describing the
+    change. Only works between requests handled by the same instance.
+    """
+    # Number of channels to remember the version of before forgetting the ones
+    # that nobody is waiting on.
+    max_channels = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def _channel(self, channel):
+        """Returns the state of a channel. Must be called with the lock held.
+        """
+        if channel not in self._channels:
+            if len(self._channels) >= self.max_channels:
+                for c, state in self._channels.items():
+                    if not state.waiters: del self._channels[c]
+            self._channels[channel] = _Channel(self._lock)
+        return self._channels[channel]
+
+    def notify(self, channel, version, message = None, wake = True):
+        """Sets the version of a channel and wakes up any requests waiting for
+        it to change (unless wake is False.)
+        """
+        self._lock.acquire()
+        try:
+            state = self._channel(channel)
+            state.version, state.message = version, message
+            if wake: state.condition.notifyAll()
+        finally:
+            self._lock.release()
+
+    def wait(self, channel, version, timeout):
+        """Blocks until the version of a channel is something other than the
+        specified version, or until the timeout (in seconds) has passed.
+        Returns the last known version of the channel and its message. The
+        version is None if it's unknown.
+        """
+        deadline = time.time() + timeout
+        self._lock.acquire()
+        try:
+            state = self._channel(channel)
+            state.waiters += 1
+            try:
+                while state.version in (None, version):
+                    remaining = deadline - time.time()
+                    if remaining <= 0: break
+                    state.condition.wait(remaining)
+            finally:
+                state.waiters -= 1
+            return state.version, state.message
+        finally:
+            self._lock.release()
+
+class MemcacheNotifier(LocalNotifier):
+    """A notifier that also works between instances, by storing the version of
+    each channel in memcache and checking it at a fixed interval while waiting.
+    Requests handled by the same instance are still woken up right away, and
+    memcache is checked at most once per interval and channel no matter how
+    many requests are waiting on the channel.
+    """
+    def __init__(self, interval = 1.0):
+        LocalNotifier.__init__(self)
+        self.interval = interval
+
+    def notify(self, channel, version, message = None, wake = True):
+        memcache.set('notify:' + channel, (version, message))
+        LocalNotifier.notify(self, channel, version, message, wake)
+
+    def _check(self, channel):
+        """Picks up the version of a channel from memcache, unless that was
+        recently done by another request.
+        """
+        self._lock.acquire()
+        try:
+            state = self._channel(channel)
+            if time.time() - state.checked < self.interval: return
+            state.checked = time.time()
+        finally:
+            self._lock.release()
+
+        value = memcache.get('notify:' + channel)
+        if value is None: return
+
+        self._lock.acquire()
+        try:
+            state = self._channel(channel)
+            if value[0] != state.version:
+                state.version, state.message = value
+                state.condition.notifyAll()
+        finally:
+            self._lock.release()
+
+    def wait(self, channel, version, timeout):
+        deadline = time.time() + timeout
+        while True:
+            self._check(channel)
+
+            remaining = deadline - time.time()
+            current = LocalNotifier.wait(self, channel, version,
+                                         max(0, min(remaining, self.interval)))
+            if current[0] not in (None, version) or remaining <= 0:
+                return current
+
+# The notifier used by the application. Can be replaced with any object that
+# has the same interface as LocalNotifier.
+notifier = MemcacheNotifier()
+
+class Histogram(object):
+    """Counts observed values in buckets with fixed upper bounds, like a
+    Prometheus histogram. The last count is for values above all the bounds.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+SECONDS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+CALLS = (0, 1, 2, 5, 10, 25, 50, 100, 250)
+BYTES = (0, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+class Stats(object):
+    """Collects histograms of how long the actions of ServiceHandlers take and
+    how much they use the data store. The histograms are kept in memory, so
+    each instance has its own, and they're lost when the instance shuts down.
+    """
+    # Name, description and bucket bounds of each metric.
+    metrics = (
+        ('service_wall_seconds', 'Wall time spent in the action.', SECONDS),
+        ('service_cpu_seconds', 'CPU time spent in the action.', SECONDS),
+        ('service_datastore_calls', 'Data store RPCs made by the action.',
+         CALLS),
+        ('service_datastore_bytes', 'Bytes sent to and received from the '
+                                    'data store by the action.', BYTES),
+        ('service_encode_seconds', 'Time spent encoding the response as '
+                                   'JSON.', SECONDS),
+    )
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric, service, action, value):
+        """Adds a value to the histogram of a metric for an action.
+        """
+        self._lock.acquire()
+        try:
+            key = (metric, service, action)
+            histogram = self._histograms.get(key)
+            if not histogram:
+                bounds = [m[2] for m in self.metrics if m[0] == metric][0]
+                histogram = self._histograms[key] = Histogram(bounds)
+            histogram.observe(value)
+        finally:
+            self._lock.release()
+
+    def render(self):
+        """Returns the histograms in the Prometheus text format.
+        """
+        self._lock.acquire()
+        try:
+            lines = []
+            for metric, description, bounds in self.metrics:
+                lines.append('# HELP %s %s' % (metric, description))
+                lines.append('# TYPE %s histogram' % metric)
+
+                for key in sorted(self._histograms):
+                    if key[0] != metric: continue
+                    histogram = self._histograms[key]
+                    labels = 'service="%s",action="%s"' % key[1:]
+
+                    total = 0
+                    for bound, count in zip(list(bounds) + ['+Inf'],
+                                            histogram.counts):
+                        total += count
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (
+                            metric, labels, bound, total))
+                    lines.append('%s_sum{%s} %r' % (metric, labels,
+                                                    float(histogram.sum)))
+                    lines.append('%s_count{%s} %d' % (metric, labels,
+                                                      histogram.count))
+            return '\n'.join(lines) + '\n'
+        finally:
+            self._lock.release()
+
+# The statistics of the instance.
+stats = Stats()
+
+class _RpcCounter(threading.local):
+    """Counts the data store RPCs made by the current thread."""
+    calls = 0
+    bytes = 0
+
+_rpcs = _RpcCounter()
+_rpc_hook_installed = False
+
+def _count_rpc(service, call, request, response):
+    _rpcs.calls += 1
+    _rpcs.bytes += request.ByteSize() + response.ByteSize()
+
+def _install_rpc_hook():
+    """Starts counting data store RPCs, unless that's already being done.
+    """
+    global _rpc_hook_installed
+    if _rpc_hook_installed: return
+
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'util.stats', _count_rpc, 'datastore_v3')
+    _rpc_hook_installed = True
+
+class StatsHandler(webapp.RequestHandler):
+    """Outputs the statistics of the instance in the Prometheus text format.
+    Should only be available to administrators.
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        self.response.out.write(stats.render())
+
+class Profiler(object):
+    """Runs functions under cProfile when asked to, and keeps the most recent
+    profiles in memcache so that they can be downloaded and inspected with the
+    pstats module.
+
+    The rate at which calls are sampled and the profiles themselves are shared
+    by all instances through memcache, so profiling can be turned on and off
+    without deploying and the profiles can be downloaded from any instance.
+    """
+    def __init__(self, size = 20, interval = 60, retries = 5):
+        self.interval = interval
+        self.retries = retries
+        self._checked = 0
+        self._rate = 0.0
+        self._size = size
+
+    def get(self, profile_id):
+        """Returns a profile in the format written by pstats.Stats.dump_stats,
+        or None if the profile is no longer kept.
+        """
+        return memcache.get('profile:%d' % profile_id)
+
+    def list(self):
+        """Returns a list of (id, time, name, seconds) tuples for the kept
+        profiles, with the most recent first.
+        """
+        return list(reversed(memcache.get('profiles') or []))
+
+    def rate(self):
+        """Returns the fraction of calls that should be profiled. It's fetched
+        from memcache at most once per interval.
+        """
+        now = time.time()
+        if now - self._checked >= self.interval:
+            self._checked = now
+            self._rate = memcache.get('profile_rate') or 0.0
+        return self._rate
+
+    def run(self, name, func, *args, **kwargs):
+        """Calls a function under cProfile and keeps the resulting profile.
+        """
+        import cProfile, marshal
+
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            profile.create_stats()
+            self._keep((start, name, elapsed), marshal.dumps(profile.stats))
+
+    def _keep(self, info, data):
+        """Stores a profile in memcache and adds it to the shared list of
+        profiles, forgetting the oldest ones.
+        """
+        if len(data) > memcache.MAX_VALUE_SIZE:
+            logging.warning('Profile of %s is too large to keep.', info[1])
+            return
+        profile_id = memcache.incr('profile_id', initial_value = 0)
+        if profile_id is None or \
+           not memcache.set('profile:%d' % profile_id, data):
+            return
+
+        client = memcache.Client()
+        for i in xrange(self.retries):
+            profiles = client.gets('profiles')
+            if profiles is None:
+                if client.add('profiles', [(profile_id,) + info]): return
+                continue
+
+            profiles = profiles + [(profile_id,) + info]
+            if client.cas('profiles', profiles[-self._size:]):
+                client.delete_multi(['profile:%d' % p[0]
+                                     for p in profiles[:-self._size]])
+                return
+
+    def sample(self):
+        """Returns True if the current call should be profiled according to
+        the sample rate.
+        """
+        rate = self.rate()
+        return rate > 0 and random.random() < rate
+
+    def set_rate(self, rate):
+        """Changes the sample rate of all instances (within the interval.)
+        """
+        memcache.set('profile_rate', rate)
+        self._rate = rate
+        self._checked = time.time()
+
+# The profiler shared by all instances.
+profiler = Profiler()
+
+class ProfilesHandler(webapp.RequestHandler):
+    """Lists the profiles kept in memcache, or outputs one of them in the
+    pstats format. POSTing a rate parameter changes the sample rate. Should
+    only be available to administrators.
+    """
+    def get(self, profile_id):
+        if profile_id:
+            data = profiler.get(int(profile_id))
+            if data is None:
+                self.error(404)
+                return
+
+            self.response.headers['Content-Type'] = 'application/octet-stream'
+            self.response.headers['Content-Disposition'] = \
+                'attachment; filename=profile-%s.pstats' % profile_id
+            self.response.out.write(data)
+            return
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        out = self.response.out
+        out.write('Sample rate: %s\n\n' % profiler.rate())
+        for profile_id, start, name, elapsed in profiler.list():
+            out.write('%d\t%s\t%s\t%.3f s\n' % (
+                profile_id,
+                time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start)),
+                name, elapsed))
+
+    def post(self, profile_id):
+        try:
+            rate = float(self.request.get('rate'))
+        except ValueError:
+            self.error(400)
+            return
+        if not 0 <= rate <= 1:
+            self.error(400)
+            return
+
+        profiler.set_rate(rate)
+        self.redirect(self.request.path)
+
 TEMPLATE_BASE = 'templates/'
 
 class ExtendedHandler(webapp.RequestHandler):
@@ -52,59 +539,607 @@ class ExtendedHandler(webapp.RequestHandler):
         else:
             values['login_url'] = users.create_login_url(path)
 
+        from google.appengine.ext.webapp import template
         self.response.out.write(template.render(TEMPLATE_BASE + tpath, values))
 
-class ServiceHandler(webapp.RequestHandler):
-    """Opens up all attributes that don't start with an underscore to HTTP
+class LRUCache(object):
+    """A cache that keeps at most size values, dropping the least recently used
+    one when it's full. Can be used by several threads at once.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        self._lock.acquire()
+        try:
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+        except KeyError:
+            return default
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(False)
+        finally:
+            self._lock.release()
+
+class TokenBucket(object):
+    """Limits how often something can be done: up to burst times in a row, and
+    then rate times per second on average. The buckets are kept in memcache,
+    so the limit applies to all instances together. If memcache is
+    unavailable, nothing is limited.
+    """
+    def __init__(self, name, rate, burst, retries = 3):
+        self.burst = burst
+        self.name = name
+        self.rate = rate
+        self.retries = retries
+
+    def take(self, key = ''):
+        """Takes a token from the bucket with the specified key. Returns False
+        if the bucket is empty.
+        """
+        client = memcache.Client()
+        mkey = 'bucket:%s:%s' % (self.name, key)
+        # The bucket is full again after this many seconds.
+        expires = int(self.burst / self.rate) + 1
+
+        for i in xrange(self.retries):
+            now = time.time()
+            value = client.gets(mkey)
+            if value is None:
+                if client.add(mkey, (self.burst - 1, now), expires): return True
+                # Either someone else added the bucket first or memcache is
+                # unavailable.
+                if client.get(mkey) is None: return True
+                continue
+
+            tokens, last = value
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1: return False
+            if client.cas(mkey, (tokens - 1, now), expires): return True
+
+        return False
+
+def encoded(json):
+    """Returns a value that has already been encoded as JSON. dumps outputs it
+    as it is, which lets the encoded parts of a response be shared between
     requests.
+    """
+    import simplejson
+    return simplejson.RawJSON(json)
 
-    Note #1: Inheritance is currently not supported. To make attributes of the
-    base class available, redefine them in the child class.
+_encoders = threading.local()
 
-    Note #2: Arguments that start with an underscore are also ignored. For the
-    call to succeed, these arguments must have a default value.
+def _encoder():
+    """Returns the JSON encoder of the current thread, which is created the
+    first time it's needed.
     """
-    def _is_public_attr(self, action):
-        return (not action.startswith('_') and
-                action in self.__class__.__dict__)
-               
-    def get(self, action):
-        out = { 'status': 'unknown',
-                'response': None }
+    encoder = getattr(_encoders, 'encoder', None)
+    if encoder: return encoder
+
+    import simplejson
+    encoder = simplejson.JSONEncoder(separators = (',', ':'))
+    _encoders.encoder = encoder
+    return encoder
+
+def dumps(obj):
+    """Encodes a value as compact JSON. Encoded values (see encoded) in it are
+    output as they are.
+    """
+    return _encoder().encode(obj)
+
+def iterencode(obj):
+    """Like dumps, but returns the JSON in chunks as they're encoded.
+    """
+    return _encoder().iterencode(obj)
+
+class _Flight(object):
+    """A call made by SingleFlight."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        self.result = None
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key: while a call is being made,
+    other calls with the same key wait for it and get its result (or its
+    exception) instead of doing the same work.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        finally:
+            self._lock.release()
 
-        if self._is_public_attr(action):
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+
+        try:
+            flight.result = func(*args, **kwargs)
+            return flight.result
+        except:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            self._lock.acquire()
             try:
-                args = {}
-                for arg in self.request.params:
-                    if arg.startswith('_'): continue
-                    args[str(arg)] = simplejson.loads(self.request.params[arg])
-
-                attr = getattr(self, action)
-                out['status'] = 'success'
-                out['response'] = attr(**args) if callable(attr) else attr
-            except Exception, e:
-                logging.exception('An exception occurred when calling %s%r.', action, args)
-
-                out['status'] = 'error'
-                out['response'] = { 'message': str(e),
-                                    'type': e.__class__.__name__ }
-        else:
-            out['status'] = 'list'
-            out['response'] = {}
-
-            for a in self.__class__.__dict__:
-                if self._is_public_attr(a):
-                    attr = getattr(self, a)
-                    if callable(attr):
-                        code = attr.im_func.func_code # Unsafe
-                        args = filter(lambda x: not x.startswith('_'),
-                                      code.co_varnames[1:code.co_argcount])
+                del self._flights[key]
+            finally:
+                self._lock.release()
+            flight.done.set()
+
+def boolean(value):
+    """Parses a boolean from a request parameter.
+    """
+    if value in ('true', '1'): return True
+    if value in ('false', '0', ''): return False
+    raise ValueError('Invalid boolean value: %r' % (value,))
+
+def json(value):
+    """Parses a JSON encoded request parameter.
+    """
+    import simplejson
+    return simplejson.loads(value)
+
+def string(value):
+    """Parses a string request parameter (which is left as it is.)
+    """
+    return value
+
+# Parsers used in place of the types that can be declared with action.
+PARSERS = {
+    bool: boolean,
+    float: float,
+    int: int,
+    long: long,
+    str: string,
+    unicode: string,
+}
+
+def action(**types):
+    """Decorator that makes a method of a ServiceHandler subclass available to
+    HTTP requests. The keyword arguments declare how request parameters are
+    parsed into the arguments of the method. Each one is either a type (bool,
+    float, int, long, str or unicode) or a function that takes the parameter
+    string and returns the value. Parameters that are not declared are
+    expected to be JSON encoded.
+    """
+    def decorator(func):
+        func.service_action = dict((arg, PARSERS.get(parse, parse))
+                                   for arg, parse in types.iteritems())
+        return func
+    return decorator
+
+class _Action(object):
+    """A method of a ServiceHandler that is available to HTTP requests."""
+    def __init__(self, func, parsers):
+        code = func.func_code
+        self.name = func.__name__
+        self.args = [arg for arg in code.co_varnames[1:code.co_argcount]
+                     if not arg.startswith('_')]
+        self.parsers = parsers
+
+class _ServiceHandlerType(type):
+    """Builds the table of actions of a ServiceHandler class when the class is
+    created. Actions of base classes are included.
+    """
+    def __init__(cls, name, bases, dct):
+        type.__init__(cls, name, bases, dct)
+
+        actions = {}
+        for klass in reversed(cls.__mro__):
+            for attr, value in klass.__dict__.iteritems():
+                parsers = getattr(value, 'service_action', None)
+                if parsers is not None:
+                    actions[attr] = _Action(value, parsers)
+                elif attr in actions:
+                    # Overridden by something that isn't an action.
+                    del actions[attr]
+
+        cls._actions = actions
+        cls._listing = None
+
+class ServiceHandler(webapp.RequestHandler):
+    """Opens up the methods decorated with action to HTTP requests. Requesting
+    the handler without an action lists the available actions and their
+    arguments.
+
+    Several calls can be made in one request by POSTing a JSON list of
+    {"action": ..., "args": {...}} objects (with the Content-Type
+    application/json) to the handler without an action. The calls are made in
+    order by the same handler instance, so anything that the handler caches
+    (such as the current player) is shared between them. A batch can have up
+    to _max_batch_calls calls, and the arguments in _blocking_args can't be set
+    in it.
+
+    An action can support conditional requests by having a method named
+    _etag_<action>, taking the same arguments as the action. It should return
+    a string that changes whenever the response of the action would change
+    (such as a version from get_version), preferably without accessing the
+    data store, or None if the response shouldn't be cached. If the client
+    already has the response, 304 Not Modified is returned without calling the
+    action. The Cache-Control header of such responses is taken from
+    _cache_control, and defaults to private. The encoded (and compressed)
+    responses with an ETag are kept in memory, so a request for a response that
+    is still in the cache is answered without calling the action.
+
+    Responses of at least _compress_threshold bytes are compressed with gzip or
+    deflate if the client accepts it.
+
+    Actions are profiled when an administrator sends the X-Profile header, or
+    when they're sampled by profiler (see ProfilesHandler.)
+
+    Note: Arguments that start with an underscore are ignored. For the call to
+    succeed, these arguments must have a default value.
+    """
+    __metaclass__ = _ServiceHandlerType
+
+    # Cache-Control headers for actions that support conditional requests.
+    _cache_control = {}
+
+    # Responses of at least this many bytes are compressed.
+    _compress_threshold = 1024
+    # The zlib compression level, from 1 (fastest) to 9 (smallest.)
+    _compress_level = 6
+    # Encoded responses are written in blocks of about this many bytes. Should
+    # be at least _compress_threshold.
+    _write_size = 8192
+
+    # Responses with an ETag, by ETag and content encoding.
+    _responses = LRUCache(200)
+
+    # Maximum number of calls in a batch.
+    _max_batch_calls = 20
+    # Arguments that make an action block, such as waiting for a change. They
+    # can't be set in a batch, since its calls are made one after another.
+    _blocking_args = ()
+
+    def _call(self, action, args):
+        """Calls an action and returns the output for it.
+        """
+        if action not in self._actions:
+            return self._error(ValueError('Invalid action.'))
+
+        _install_rpc_hook()
+        calls, bytes = _rpcs.calls, _rpcs.bytes
+        cpu = quota.get_request_cpu_usage()
+        start = time.time()
+
+        try:
+            func = getattr(self, action)
+            if self._profile():
+                name = '%s.%s' % (self.__class__.__name__, action)
+                result = profiler.run(name, func, **args)
+            else:
+                result = func(**args)
+
+            out = { 'status': 'success',
+                    'response': result }
+        except Exception, e:
+            logging.exception('An exception occurred when calling %s%r.', action, args)
+            out = self._error(e)
+
+        service = self.__class__.__name__
+        stats.observe('service_wall_seconds', service, action,
+                      time.time() - start)
+        stats.observe('service_cpu_seconds', service, action,
+                      quota.megacycles_to_cpu_seconds(
+                          quota.get_request_cpu_usage() - cpu))
+        stats.observe('service_datastore_calls', service, action,
+                      _rpcs.calls - calls)
+        stats.observe('service_datastore_bytes', service, action,
+                      _rpcs.bytes - bytes)
+
+        return out
+
+    def _error(self, e):
+        return { 'status': 'error',
+                 'response': { 'message': str(e),
+                               'type': e.__class__.__name__ } }
+
+    def _etag(self, action, args):
+        """Returns the ETag for a call, or None if the action doesn't support
+        conditional requests.
+        """
+        func = getattr(self, '_etag_' + action, None)
+        if not func: return None
+
+        version = func(**args)
+        if version is None: return None
+
+        import hashlib
+        key = '%s|%s|%r' % (action, version, sorted(args.items()))
+        return '"%s"' % hashlib.md5(key).hexdigest()
+
+    def _identity(self):
+        """Returns a string that identifies the user making the request without
+        accessing the data store, or None if the user is unknown.
+        """
+        user = users.get_current_user()
+        if user: return 'user:' + user.user_id()
+
+        session = self.request.cookies.get('session')
+        if session: return 'session:' + session
+
+        return None
+
+    def _profile(self):
+        """Returns True if the current call should be profiled. Calls are
+        profiled when an administrator sends the X-Profile header, or when
+        they're picked by the sample rate of the profiler.
+        """
+        if self.request.headers.get('X-Profile') and \
+           users.is_current_user_admin():
+            return True
+        return profiler.sample()
+
+    def _encoding(self):
+        """Returns the content encoding that the client prefers out of gzip and
+        deflate, or None if it accepts neither.
+        """
+        accepted = []
+        for value in self.request.headers.get('Accept-Encoding', '').split(','):
+            params = value.split(';')
+            if 'q=0' in [p.strip() for p in params[1:]]: continue
+            accepted.append(params[0].strip())
+
+        for encoding in ('gzip', 'deflate'):
+            if encoding in accepted: return encoding
+        return None
+
+    def _send(self, body, encoding = None):
+        self._send_headers(encoding)
+        self.response.out.write(body)
+
+    def _send_headers(self, encoding):
+        headers = self.response.headers
+        if 'Cache-Control' not in headers:
+            headers['Cache-Control'] = 'no-cache'
+        headers['Content-Type'] = 'application/json'
+        headers['Vary'] = 'Accept-Encoding'
+        if encoding: headers['Content-Encoding'] = encoding
+
+    def _write(self, out, action = None, etag = None):
+        """Outputs the result of a request. The result is encoded in chunks
+        which are written to the response in blocks of _write_size bytes, so
+        the whole encoded result is never held in memory on its own. Results
+        of at least _compress_threshold bytes are compressed on the way.
+
+        If action is specified, the time it takes to output the result is
+        recorded for it. If etag is specified, the output is kept in
+        _responses.
+        """
+        start = time.time()
+        accepted = self._encoding()
+        compressor = None
+        encoding = None
+        kept = []
+        started = False
+
+        block, size = [], 0
+        # A None chunk marks the end of the output.
+        for chunk in itertools.chain(iterencode(out), [None]):
+            if chunk is not None:
+                block.append(chunk)
+                size += len(chunk)
+                if size < self._write_size: continue
+
+            data = ''.join(block)
+            block, size = [], 0
+
+            if not started:
+                # Only output that fits in the first block can be too small to
+                # compress.
+                if accepted and (chunk is not None or
+                                 len(data) >= self._compress_threshold):
+                    import zlib
+                    encoding = accepted
+                    if encoding == 'gzip':
+                        compressor = zlib.compressobj(self._compress_level,
+                                                      zlib.DEFLATED,
+                                                      16 + zlib.MAX_WBITS)
                     else:
-                        args = None
+                        compressor = zlib.compressobj(self._compress_level)
+                self._send_headers(encoding)
+                started = True
+
+            if compressor:
+                data = compressor.compress(data)
+                if chunk is None: data += compressor.flush()
+            if data:
+                self.response.out.write(data)
+                if etag: kept.append(data)
+
+        if action:
+            stats.observe('service_encode_seconds', self.__class__.__name__,
+                          action, time.time() - start)
+        if etag:
+            self._responses.set((etag, accepted), (''.join(kept), encoding))
+
+    def get(self, action):
+        if action not in self._actions:
+            cls = self.__class__
+            if not cls._listing:
+                cls._listing = dumps(
+                    { 'status': 'list',
+                      'response': dict((a.name, a.args)
+                                       for a in cls._actions.itervalues()) })
+
+            self._send(cls._listing)
+            return
+
+        parsers = self._actions[action].parsers
+        try:
+            args = {}
+            for arg in self.request.params:
+                if arg.startswith('_'): continue
+                args[str(arg)] = parsers.get(arg, json)(self.request.params[arg])
+
+            etag = self._etag(action, args)
+        except Exception, e:
+            logging.exception('An exception occurred when calling %s.', action)
+            self._write(self._error(e))
+            return
+
+        if etag:
+            matches = self.request.headers.get('If-None-Match', '')
+            if etag in [m.strip() for m in matches.split(',')]:
+                self.response.set_status(304)
+                self.response.headers['ETag'] = etag
+                return
+
+            cached = self._responses.get((etag, self._encoding()))
+            if cached:
+                self.response.headers['ETag'] = etag
+                self.response.headers['Cache-Control'] = \
+                    self._cache_control.get(action, 'private, no-cache')
+                self._send(*cached)
+                return
+
+        out = self._call(action, args)
+
+        if etag and out['status'] == 'success':
+            self.response.headers['ETag'] = etag
+            self.response.headers['Cache-Control'] = \
+                self._cache_control.get(action, 'private, no-cache')
+        else:
+            etag = None
+
+        self._write(out, action, etag)
+
+    def _batch_call(self, call):
+        """Returns the action and arguments of a call in a batch. Arguments
+        that the action declares a parser for are parsed like request
+        parameters: strings as they are, and other values as their JSON (so
+        that 5 becomes '5' and true becomes 'true'.) Arguments that are null
+        are left out.
+        """
+        if not isinstance(call, dict):
+            raise ValueError('Expected a call object.')
+        action = call.get('action', '')
+        if not isinstance(action, basestring):
+            raise ValueError('Invalid action.')
+        values = call.get('args', {})
+        if not isinstance(values, dict):
+            raise ValueError('Expected an object of arguments.')
+
+        parsers = self._actions[action].parsers \
+                  if action in self._actions else {}
+        args = {}
+        for arg, value in values.iteritems():
+            if arg.startswith('_') or value is None: continue
+            parse = parsers.get(arg)
+            if parse and parse is not json:
+                if not isinstance(value, basestring): value = dumps(value)
+                value = parse(value)
+            if value and arg in self._blocking_args:
+                raise ValueError('%s is not allowed in a batch.' % arg)
+            args[str(arg)] = value
+        return action, args
+
+    def post(self, action):
+        content_type = self.request.headers.get('Content-Type', '')
+        if action or not content_type.startswith('application/json'):
+            self.get(action)
+            return
+
+        import simplejson
+        try:
+            try:
+                calls = simplejson.loads(self.request.body)
+            except RuntimeError:
+                # The body is nested too deeply to be decoded.
+                raise ValueError('Invalid JSON.')
+            if not isinstance(calls, list):
+                raise ValueError('Expected a list of calls.')
+            if len(calls) > self._max_batch_calls:
+                raise ValueError('Too many calls in a batch (the maximum is '
+                                 '%d.)' % self._max_batch_calls)
+        except ValueError, e:
+            self._write(self._error(e))
+            return
+
+        results = []
+        for call in calls:
+            try:
+                action, args = self._batch_call(call)
+            except (TypeError, ValueError), e:
+                results.append(self._error(e))
+                continue
+
+            results.append(self._call(action, args))
+
+        # The encode time of a batch is recorded for the action "batch".
+        self._write({ 'status': 'batch',
+                      'response': results }, 'batch')
+
+class StreamHandler(webapp.RequestHandler):
+    """Pushes the changes of a notifier channel (see LocalNotifier) to the
+    client as Server-Sent Events. Subclasses decide which channel to use by
+    implementing _channel, which gets the groups of the URL pattern.
+
+    The id of each event is the version it represents. The client sends the
+    last version it has seen in the Last-Event-ID header (which EventSource
+    does when it reconnects) or the 'last' parameter and gets the versions that
+    come after it. Versions and messages are encoded as JSON.
+    """
+    # Maximum number of seconds to keep a connection open.
+    timeout = 20
+    # Maximum number of events to send before closing the connection. App
+    # Engine sends the response when the request completes, so the connection
+    # is closed after each event and the client reconnects.
+    max_events = 1
+    # Number of milliseconds the client should wait before reconnecting.
+    retry = 100
+
+    def _channel(self, *args):
+        raise NotImplementedError()
+
+    def get(self, *args):
+        import simplejson
+        channel = self._channel(*args)
+
+        last = (self.request.headers.get('Last-Event-ID') or
+                self.request.get('last'))
+        try:
+            version = simplejson.loads(last) if last else None
+        except ValueError:
+            version = None
+
+        self.response.headers['Content-Type'] = 'text/event-stream'
+        self.response.headers['Cache-Control'] = 'no-cache'
+
+        out = self.response.out
+        out.write('retry: %d\n\n' % self.retry)
+
+        deadline = time.time() + self.timeout
+        for i in xrange(self.max_events):
+            remaining = deadline - time.time()
+            if remaining <= 0: break
 
-                    out['response'][a] = args
-            
-        self.response.headers['Content-Type'] = 'application/json'
-        self.response.out.write(simplejson.dumps(out, separators=(',', ':')))
+            current, message = notifier.wait(channel, version, remaining)
+            if current in (None, version): break
 
-    post = get
+            out.write('id: %s\ndata: %s\n\n' % (dumps(current), dumps(message)))
+            version = current